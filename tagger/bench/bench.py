@@ -0,0 +1,232 @@
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import dataset
+
+# Load and benchmark driver for the tagger HTTP API. Only uses the standard library, so it runs outside of the tagger image.
+#
+#   python3 bench.py load --values 100000  # Fills the database the tagger is connected to
+#   python3 bench.py run --duration 60     # Drives the endpoints and reports throughput and latency percentiles
+#
+# Both commands need the same --seed and dataset sizes to agree on what's in the database.
+# Writes made by 'run' only touch values and tags of their own ('bench-*'), so runs can be repeated on the same dataset.
+
+class Client:
+  def __init__(self, url, timeout):
+    self.url = url.rstrip('/')
+    self.timeout = timeout
+
+  def post(self, path, body):
+    request = urllib.request.Request(self.url + path, data=json.dumps(body).encode('utf-8'), headers={'Content-Type': 'application/json'}, method='POST')
+    with urllib.request.urlopen(request, timeout=self.timeout) as response:
+      retval = json.loads(response.read())
+    if 'error_id' in retval:
+      raise RuntimeError('{} failed with error {}: {}'.format(path, retval['error_id'], retval['error_msg']))
+    return retval
+
+# Every operation takes (client, data, rng, state) and sends exactly one request.
+# state is private to the worker thread running it.
+
+def op_tag(client, data, rng, state):
+  value = 'bench-{}-{}'.format(state['worker'], state['counter'])
+  state['counter'] += 1
+  client.post('/tag', data.random_entry(rng, value))
+  state['tagged'].append(value)
+
+def op_get(client, data, rng, state):
+  client.post('/get', {'value': [data.random_value(rng) for _ in range(rng.randint(1, 10))]})
+
+def op_search(client, data, rng, state):
+  client.post('/search', {'query': [data.random_topic(rng) for _ in range(rng.randint(1, 2))], 'limit': 100})
+
+def op_search_negative(client, data, rng, state):
+  client.post('/search', {'query': [data.random_topic(rng), '-' + data.random_topic(rng)], 'limit': 100})
+
+def op_search_wildcard(client, data, rng, state):
+  client.post('/search', {'query': [dataset.topic_name(rng.randrange(1, 10)) + '%'], 'limit': 100})
+
+def op_search_value(client, data, rng, state):
+  name, low, high, fraction = rng.choice(dataset.VALUE_TAGS)
+  client.post('/search', {'query': [data.random_topic(rng), '{}{{>{}}}'.format(name, rng.randint(low, high))], 'limit': 100})
+
+# Untags values tagged by op_tag, falling back to tagging one when there are none left
+def op_untag(client, data, rng, state):
+  if len(state['tagged']) == 0:
+    return op_tag(client, data, rng, state)
+  client.post('/untag', {'value': state['tagged'].pop(), 'all': True})
+
+def op_tag_tags(client, data, rng, state):
+  implied = 'bench-implied-{}-{}'.format(state['worker'], state['counter'])
+  state['counter'] += 1
+  client.post('/tag-tags', {'multi_tags': {dataset.group_name(rng.randrange(data.depth), rng.randrange(data.groups)): [implied]}})
+
+OPERATIONS = {
+  'tag': op_tag,
+  'get': op_get,
+  'search': op_search,
+  'search-negative': op_search_negative,
+  'search-wildcard': op_search_wildcard,
+  'search-value': op_search_value,
+  'untag': op_untag,
+  'tag-tags': op_tag_tags
+}
+
+DEFAULT_MIX = 'search=30,search-negative=10,search-wildcard=5,search-value=10,get=25,tag=10,untag=5,tag-tags=5'
+
+def parse_mix(mix):
+  retval = {}
+  for part in mix.split(','):
+    name, weight = part.split('=', 1)
+    if name not in OPERATIONS:
+      raise ValueError('Unknown operation \'{}\', expected one of {}'.format(name, ', '.join(OPERATIONS)))
+    retval[name] = float(weight)
+  return retval
+
+def percentile(ordered, p):
+  if len(ordered) == 0:
+    return None
+  return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+class Results:
+  def __init__(self):
+    self._latencies = {} # operation -> seconds[]
+    self._errors = {} # operation -> count
+    self._lock = threading.Lock()
+
+  def record(self, operation, seconds, failed):
+    with self._lock:
+      if failed:
+        self._errors[operation] = self._errors.get(operation, 0) + 1
+      else:
+        self._latencies.setdefault(operation, []).append(seconds)
+
+  def summary(self, duration):
+    retval = {}
+    for operation in sorted(set(self._latencies) | set(self._errors)):
+      latencies = sorted(self._latencies.get(operation, []))
+      retval[operation] = {
+        'requests': len(latencies),
+        'errors': self._errors.get(operation, 0),
+        'throughput': len(latencies) / duration,
+        'p50_ms': _ms(percentile(latencies, 50)),
+        'p90_ms': _ms(percentile(latencies, 90)),
+        'p99_ms': _ms(percentile(latencies, 99)),
+        'max_ms': _ms(latencies[-1] if len(latencies) > 0 else None)
+      }
+    return retval
+
+def _ms(seconds):
+  return round(seconds * 1000, 3) if seconds is not None else None
+
+def load(args):
+  client = Client(args.url, args.timeout)
+  data = make_dataset(args)
+
+  start = time.perf_counter()
+  loaded = 0
+  for batch in data.entries(args.batch_size):
+    client.post('/tag-batch', {'values': batch})
+    loaded += len(batch)
+    print('\rTagged {}/{} values'.format(loaded, data.values), end='', file=sys.stderr)
+  print(file=sys.stderr)
+
+  client.post('/tag', data.group_entry())
+  for level, implications in data.implications():
+    client.post('/tag-tags', {'multi_tags': implications})
+    print('Added implications of level {}'.format(level), file=sys.stderr)
+
+  print('Loaded in {:.1f}s'.format(time.perf_counter() - start), file=sys.stderr)
+
+def worker(client, data, mix, results, deadline, index, seed):
+  rng = random.Random(seed * 1000003 + index)
+  state = {'worker': index, 'counter': 0, 'tagged': []}
+  names = list(mix)
+  weights = [mix[name] for name in names]
+
+  while time.monotonic() < deadline:
+    operation = rng.choices(names, weights)[0]
+    start = time.perf_counter()
+    failed = False
+    try:
+      OPERATIONS[operation](client, data, rng, state)
+    except (urllib.error.URLError, RuntimeError, OSError) as e:
+      failed = True
+      print('{}: {}'.format(operation, e), file=sys.stderr)
+    results.record(operation, time.perf_counter() - start, failed)
+
+def run(args):
+  client = Client(args.url, args.timeout)
+  data = make_dataset(args)
+  mix = parse_mix(args.mix)
+
+  if args.warmup > 0:
+    run_workers(client, data, mix, Results(), args.concurrency, args.warmup, args.seed + 1)
+
+  results = Results()
+  duration = run_workers(client, data, mix, results, args.concurrency, args.duration, args.seed)
+  summary = results.summary(duration)
+  print_summary(summary, duration, args.concurrency)
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump({'duration': duration, 'concurrency': args.concurrency, 'mix': mix, 'seed': args.seed, 'operations': summary}, f, indent=2)
+
+def run_workers(client, data, mix, results, concurrency, duration, seed):
+  start = time.perf_counter()
+  deadline = time.monotonic() + duration
+  with ThreadPoolExecutor(max_workers=concurrency) as executor:
+    futures = [executor.submit(worker, client, data, mix, results, deadline, i, seed) for i in range(concurrency)]
+    for future in futures:
+      future.result()
+  return time.perf_counter() - start
+
+def print_summary(summary, duration, concurrency):
+  print('{} workers for {:.1f}s'.format(concurrency, duration))
+  print('{:<16} {:>9} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9}'.format('operation', 'requests', 'errors', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+  for operation, s in summary.items():
+    print('{:<16} {:>9} {:>7} {:>9.1f} {:>9} {:>9} {:>9} {:>9}'.format(operation, s['requests'], s['errors'], s['throughput'], _cell(s['p50_ms']), _cell(s['p90_ms']), _cell(s['p99_ms']), _cell(s['max_ms'])))
+  print('{:<16} {:>9} {:>7} {:>9.1f}'.format('total', sum(s['requests'] for s in summary.values()), sum(s['errors'] for s in summary.values()), sum(s['throughput'] for s in summary.values())))
+
+def _cell(value):
+  return '-' if value is None else '{:.1f}'.format(value)
+
+def make_dataset(args):
+  return dataset.Dataset(args.seed, args.values, args.vocabulary, args.zipf, args.max_tags, args.groups, args.depth)
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Load a synthetic dataset into the tagger and benchmark its endpoints')
+  parser.add_argument('--url', default='http://localhost:30001', help='Base URL of the tagger')
+  parser.add_argument('--timeout', type=float, default=30, help='Seconds before a request is counted as failed')
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--values', type=int, default=10000, help='Amount of tagged values')
+  parser.add_argument('--vocabulary', type=int, default=1000, help='Amount of distinct multitags')
+  parser.add_argument('--zipf', type=float, default=1.1, help='Exponent of the Zipfian multitag usage')
+  parser.add_argument('--max-tags', type=int, default=8, help='Maximum amount of multitags per value')
+  parser.add_argument('--groups', type=int, default=20, help='Amount of implication groups per level')
+  parser.add_argument('--depth', type=int, default=3, help='Amount of implication levels')
+  commands = parser.add_subparsers(dest='command', required=True)
+
+  load_parser = commands.add_parser('load', help='Tag the synthetic dataset')
+  load_parser.add_argument('--batch-size', type=int, default=500, help='Values per /tag-batch request')
+  load_parser.set_defaults(func=load)
+
+  run_parser = commands.add_parser('run', help='Benchmark the endpoints against a loaded dataset')
+  run_parser.add_argument('--concurrency', type=int, default=8, help='Amount of concurrent clients')
+  run_parser.add_argument('--duration', type=float, default=30, help='Seconds to measure for')
+  run_parser.add_argument('--warmup', type=float, default=5, help='Seconds to run before measuring')
+  run_parser.add_argument('--mix', default=DEFAULT_MIX, help='Comma separated operation=weight pairs. Operations: ' + ', '.join(OPERATIONS))
+  run_parser.add_argument('--output', help='Also write the results as JSON to this file')
+  run_parser.set_defaults(func=run)
+
+  args = parser.parse_args(argv)
+  args.func(args)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,90 @@
+import bisect
+import itertools
+import random
+
+# Deterministic synthetic dataset. The same seed and sizes always produce the same values and tags,
+# so runs against freshly loaded databases can be compared with each other.
+#
+# * Multitags ('topic-<rank>') are used with Zipfian frequencies: the tag of rank k is used about 1/k^s as often as the most used one
+# * Every value tag name has its own range of values, and is given to a fixed fraction of the tagged values
+# * Implications ('group-<level>-<i>' -> topics) form a hierarchy, every group implying a few groups of the level below it,
+#   and the lowest level implying topics
+
+VALUE_TAGS = [
+  # name, min value, max value, fraction of tagged values having it
+  ('rating', 1, 5, 0.8),
+  ('year', 1950, 2030, 0.5),
+  ('size', 0, 1000000, 0.3)
+]
+
+def value_name(i):
+  return 'value-{}'.format(i)
+
+def topic_name(rank):
+  return 'topic-{}'.format(rank)
+
+def group_name(level, i):
+  return 'group-{}-{}'.format(level, i)
+
+class Zipf:
+  def __init__(self, size, exponent):
+    self.size = size
+    self._cumulative = list(itertools.accumulate(1 / ((k + 1) ** exponent) for k in range(size)))
+
+  # 0 based rank
+  def sample(self, rng):
+    return bisect.bisect_left(self._cumulative, rng.random() * self._cumulative[-1])
+
+class Dataset:
+  def __init__(self, seed, values, vocabulary, exponent, max_tags, groups, depth):
+    self.seed = seed
+    self.values = values
+    self.vocabulary = vocabulary
+    self.max_tags = max_tags
+    self.groups = groups
+    self.depth = depth
+    self.zipf = Zipf(vocabulary, exponent)
+
+  def random_topic(self, rng):
+    return topic_name(self.zipf.sample(rng))
+
+  def random_value(self, rng):
+    return value_name(rng.randrange(self.values))
+
+  def random_value_tags(self, rng):
+    return [{'name': name, 'value': rng.randint(low, high)} for name, low, high, fraction in VALUE_TAGS if rng.random() < fraction]
+
+  def random_entry(self, rng, value):
+    entry = {'value': value, 'multi_tags': sorted(set(self.random_topic(rng) for _ in range(rng.randint(1, self.max_tags))))}
+    value_tags = self.random_value_tags(rng)
+    if len(value_tags) > 0:
+      entry['value_tags'] = value_tags
+    return entry
+
+  # Yields lists of /tag-batch entries
+  def entries(self, batch_size):
+    rng = random.Random(self.seed)
+    batch = []
+    for i in range(self.values):
+      batch.append(self.random_entry(rng, value_name(i)))
+      if len(batch) == batch_size:
+        yield batch
+        batch = []
+    if len(batch) > 0:
+      yield batch
+
+  # /tag-tags only creates the implied tags, so the groups have to be tagged onto something first
+  def group_entry(self):
+    return {'value': 'groups', 'multi_tags': [group_name(level, i) for level in range(self.depth) for i in range(self.groups)]}
+
+  # Yields /tag-tags 'multi_tags' payloads, one per level, top level first
+  def implications(self):
+    rng = random.Random(self.seed + 1)
+    for level in range(self.depth):
+      retval = {}
+      for i in range(self.groups):
+        if level == self.depth - 1:
+          retval[group_name(level, i)] = sorted(set(self.random_topic(rng) for _ in range(self.max_tags)))
+        else:
+          retval[group_name(level, i)] = sorted(set(group_name(level + 1, rng.randrange(self.groups)) for _ in range(3)))
+      yield level, retval
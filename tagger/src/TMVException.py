@@ -3,6 +3,8 @@ class TMVException(Exception):
   ID_DB_CONNECTION = 1
   ID_TAGGED_NOT_FOUND = 2
   ID_FAULTY_INPUT = 3
+  ID_SEARCH_ENGINE = 4
+  ID_INVALID_TAG_NAME = 5
 
   ID_404 = 404
   ID_405 = 405
@@ -0,0 +1,328 @@
+import bisect
+import re
+import threading
+from array import array
+
+try:
+  from pyroaring import BitMap
+except ImportError:
+  BitMap = None
+
+from TMVException import TMVException
+
+# Converts a LIKE pattern into an equivalent regex. '%' matches any string, '_' any character, and '\' escapes the next one
+def like_to_regex(pattern):
+  retval = ''
+  escaped = False
+  for c in pattern:
+    if escaped:
+      retval += re.escape(c)
+      escaped = False
+    elif c == '\\':
+      escaped = True
+    elif c == '%':
+      retval += '.*'
+    elif c == '_':
+      retval += '.'
+    else:
+      retval += re.escape(c)
+  return re.compile(retval, re.DOTALL)
+
+# Numbers are never given back, a key keeps its number until the next load even if no tagged value has it anymore
+def _key_number(state, key):
+  number = state['key_numbers'].get(key)
+  if number is None:
+    number = len(state['keys'])
+    state['keys'].append(key)
+    state['key_numbers'][key] = number
+  return number
+
+# In memory search engine, answering the same queries as database.compile_search.
+#
+# Every multitag, and every valuetag by both its fullname ('<name><value>') and its (name, value), maps to a
+# compressed bitmap of the IDs of the tagged values carrying it. Positive terms are intersected, negative terms
+# subtracted, and value comparisons ('name{>5}') are answered by the sorted values of each valuetag name.
+class BitmapIndex:
+  def __init__(self):
+    if BitMap is None:
+      raise TMVException(TMVException.ID_SEARCH_ENGINE, 'The bitmap search engine requires the pyroaring package')
+
+    # Held while reading from or changing the index
+    self._lock = threading.Lock()
+    # Held while reading changes from the database until they've been applied, so they're applied in the order they were read
+    self._refresh_lock = threading.Lock()
+    # Held for a whole load, so loads don't overlap
+    self._load_lock = threading.Lock()
+    # Tagged IDs refreshed while a load is reading its snapshot, None if no load is running
+    self._refreshed_during_load = None
+    self._swap(self._build({}, {}, {}))
+
+  # values: tagged ID -> tagged value
+  # multi: multitag value -> tagged IDs
+  # named: valuetag name -> valuetag value -> tagged IDs
+  #
+  # Returns the state to _swap in. Besides the bitmaps, the state knows the tags of every tagged ID, so a refresh can take it
+  # out of the bitmaps it was in. Those are kept compact: every ('multi', value) and ('value', name, value) key is numbered,
+  # and a tagged ID only holds an array of key numbers.
+  def _build(self, values, multi, named):
+    state = {
+      'values': values,
+      'multi': {},
+      'fullname': {},
+      'named': {},
+      'sorted': {},
+      'tags': {}, # tagged ID -> array of key numbers
+      'keys': [], # key number -> key
+      'key_numbers': {} # key -> key number
+    }
+
+    for tag in multi:
+      state['multi'][tag] = BitMap(multi[tag])
+      number = _key_number(state, ('multi', tag))
+      for tagged_id in multi[tag]:
+        state['tags'].setdefault(tagged_id, array('I')).append(number)
+
+    for name in named:
+      state['named'][name] = {}
+      for value in named[name]:
+        ids = BitMap(named[name][value])
+        state['named'][name][value] = ids
+        fullname = name + str(value)
+        if fullname in state['fullname']:
+          state['fullname'][fullname] |= ids
+        else:
+          state['fullname'][fullname] = BitMap(ids)
+        number = _key_number(state, ('value', name, value))
+        for tagged_id in ids:
+          state['tags'].setdefault(tagged_id, array('I')).append(number)
+      state['sorted'][name] = sorted(state['named'][name])
+    return state
+
+  # Must be called with the lock held
+  def _swap(self, state):
+    self._state = state
+    self._values = state['values']
+    self._multi = state['multi']
+    self._fullname = state['fullname']
+    self._named = state['named']
+    self._sorted = state['sorted']
+    self._tags = state['tags']
+
+  # Reads everything through server side cursors, in a single repeatable read transaction so the three reads agree.
+  # Searches are answered, and refreshes applied, from the previous state until the new one is complete. Refreshes made
+  # while the snapshot was read may have been missed by it, so their tagged IDs are read again once it's swapped in.
+  def load(self, conn, names, batch_size):
+    values = {}
+    multi = {}
+    named = {}
+
+    with self._load_lock:
+      with self._refresh_lock:
+        self._refreshed_during_load = set()
+
+      try:
+        conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        try:
+          for tagged_id, value in self._read(conn, batch_size, 'SELECT id, value FROM ' + names['tagged']):
+            values[tagged_id] = value
+          for tagged_id, tag in self._read(conn, batch_size, 'SELECT mtt.tagged_id, mt.value FROM ' + names['tagged_multitags'] + ' AS mtt JOIN ' + names['multitags'] + ' AS mt ON mt.id = mtt.tag_id'):
+            multi.setdefault(tag, []).append(tagged_id)
+          for tagged_id, name, value in self._read(conn, batch_size, 'SELECT vtt.tagged_id, vt.name, vt.value FROM ' + names['tagged_valuetags'] + ' AS vtt JOIN ' + names['valuetags'] + ' AS vt ON vt.id = vtt.tag_id'):
+            named.setdefault(name, {}).setdefault(value, []).append(tagged_id)
+        finally:
+          conn.rollback()
+          conn.set_session(isolation_level='DEFAULT', readonly='DEFAULT')
+
+        state = self._build(values, multi, named)
+        values = multi = named = None
+
+        with self._refresh_lock:
+          with self._lock:
+            self._swap(state)
+          refreshed = self._refreshed_during_load
+          self._refreshed_during_load = None
+
+          cur = conn.cursor()
+          try:
+            self._apply_refresh(cur, names, list(refreshed))
+          finally:
+            cur.close()
+            conn.rollback()
+      finally:
+        with self._refresh_lock:
+          self._refreshed_during_load = None
+
+  def _read(self, conn, batch_size, sql):
+    cur = conn.cursor(name='tmv_bitmap_load')
+    try:
+      cur.itersize = batch_size
+      cur.execute(sql)
+      for row in cur:
+        yield row
+    finally:
+      cur.close()
+
+  # Re-reads the current state of the given tagged values from the database
+  def refresh(self, cur, names, tagged_ids):
+    tagged_ids = list(set(tagged_ids))
+    if len(tagged_ids) == 0:
+      return
+
+    with self._refresh_lock:
+      if self._refreshed_during_load is not None:
+        self._refreshed_during_load.update(tagged_ids)
+      self._apply_refresh(cur, names, tagged_ids)
+
+  # Must be called with the refresh lock held
+  def _apply_refresh(self, cur, names, tagged_ids):
+    if len(tagged_ids) == 0:
+      return
+
+    cur.execute('SELECT id, value FROM ' + names['tagged'] + ' WHERE id = ANY(%s)', (tagged_ids,))
+    values = dict(cur.fetchall())
+
+    tags = {tagged_id: set() for tagged_id in tagged_ids}
+    cur.execute('SELECT mtt.tagged_id, mt.value FROM ' + names['tagged_multitags'] + ' AS mtt JOIN ' + names['multitags'] + ' AS mt ON mt.id = mtt.tag_id WHERE mtt.tagged_id = ANY(%s)', (tagged_ids,))
+    for tagged_id, tag in cur:
+      tags[tagged_id].add(('multi', tag))
+    cur.execute('SELECT vtt.tagged_id, vt.name, vt.value FROM ' + names['tagged_valuetags'] + ' AS vtt JOIN ' + names['valuetags'] + ' AS vt ON vt.id = vtt.tag_id WHERE vtt.tagged_id = ANY(%s)', (tagged_ids,))
+    for tagged_id, name, value in cur:
+      tags[tagged_id].add(('value', name, value))
+
+    with self._lock:
+      for tagged_id in tagged_ids:
+        self._update(tagged_id, values.get(tagged_id), tags[tagged_id])
+
+  # Must be called with the lock held
+  def _update(self, tagged_id, value, tags):
+    keys = self._state['keys']
+    for number in self._tags.pop(tagged_id, ()):
+      self._remove_key(tagged_id, keys[number])
+    self._values.pop(tagged_id, None)
+
+    if value is None:
+      return
+    self._values[tagged_id] = value
+    for key in tags:
+      self._add_key(tagged_id, key)
+    if len(tags) > 0:
+      self._tags[tagged_id] = array('I', sorted(_key_number(self._state, key) for key in tags))
+
+  def _add_key(self, tagged_id, key):
+    if key[0] == 'multi':
+      self._multi.setdefault(key[1], BitMap()).add(tagged_id)
+      return
+
+    name, value = key[1], key[2]
+    values = self._named.setdefault(name, {})
+    if value not in values:
+      values[value] = BitMap()
+      bisect.insort(self._sorted.setdefault(name, []), value)
+    values[value].add(tagged_id)
+    self._fullname.setdefault(name + str(value), BitMap()).add(tagged_id)
+
+  def _remove_key(self, tagged_id, key):
+    if key[0] == 'multi':
+      ids = self._multi[key[1]]
+      ids.discard(tagged_id)
+      if len(ids) == 0:
+        del self._multi[key[1]]
+      return
+
+    name, value = key[1], key[2]
+    ids = self._named[name][value]
+    ids.discard(tagged_id)
+    if len(ids) == 0:
+      del self._named[name][value]
+      self._sorted[name].remove(value)
+      if len(self._named[name]) == 0:
+        del self._named[name]
+        del self._sorted[name]
+
+    # Different valuetags can share a fullname ('a1' + 5 and 'a' + 15), which is fine since _update removes all keys of an ID at once
+    fullname = name + str(value)
+    ids = self._fullname.get(fullname)
+    if ids is not None:
+      ids.discard(tagged_id)
+      if len(ids) == 0:
+        del self._fullname[fullname]
+
+  def _matching(self, bitmaps, pattern):
+    if '%' not in pattern:
+      return [bitmaps[pattern]] if pattern in bitmaps else []
+    regex = like_to_regex(pattern)
+    return [bitmaps[key] for key in bitmaps if regex.fullmatch(key)]
+
+  def _term_ids(self, term, value_term):
+    if not value_term:
+      return BitMap.union(BitMap(), *(self._matching(self._multi, term) + self._matching(self._fullname, term)))
+
+    name, comparator, value = term
+    if name not in self._named:
+      return BitMap()
+    values = self._sorted[name]
+
+    if comparator == '>':
+      matching = values[bisect.bisect_right(values, value):]
+    elif comparator == '>=':
+      matching = values[bisect.bisect_left(values, value):]
+    elif comparator == '<':
+      matching = values[:bisect.bisect_left(values, value)]
+    elif comparator == '<=':
+      matching = values[:bisect.bisect_right(values, value)]
+    else: # '!=' and '<>'
+      matching = [v for v in values if v != value]
+    return BitMap.union(BitMap(), *(self._named[name][v] for v in matching))
+
+  # Takes the output of database.split_query, with the value terms already parsed by database.parse_value_query.
+  # Returns the same as database.search.
+  def search(self, query, limit=None, after_id=None):
+    if len(query['positive']) + len(query['pos_value']) == 0:
+      return [], None
+
+    with self._lock:
+      # Start with the smallest positive term, so the intersection never grows
+      positive = [self._term_ids(t, False) for t in query['positive']] + [self._term_ids(t, True) for t in query['pos_value']]
+      positive.sort(key=len)
+      ids = BitMap(positive[0])
+      for term_ids in positive[1:]:
+        if len(ids) == 0:
+          break
+        ids &= term_ids
+
+      for term in query['negative']:
+        if len(ids) == 0:
+          break
+        ids -= self._term_ids(term, False)
+      for term in query['neg_value']:
+        if len(ids) == 0:
+          break
+        ids -= self._term_ids(term, True)
+
+      if limit is None:
+        return [self._values[i] for i in ids], None
+
+      start = ids.rank(after_id) if after_id is not None else 0
+      page = ids[start:start + limit + 1]
+      last_id = None
+      if len(page) > limit:
+        page = page[:limit]
+        last_id = page[-1]
+      return [self._values[i] for i in page], last_id
+
+  # Tagged IDs carrying the given tag, to know what to refresh when the tag changes
+  def ids_with_multitag(self, tag):
+    with self._lock:
+      return list(self._multi.get(tag, ()))
+
+  def ids_with_valuetag(self, name, value):
+    with self._lock:
+      return list(self._named.get(name, {}).get(value, ()))
+
+  def stats(self):
+    with self._lock:
+      return {
+        'tagged': len(self._values),
+        'multi_tags': len(self._multi),
+        'value_tags': sum(len(v) for v in self._named.values())
+      }
@@ -0,0 +1,77 @@
+import threading
+import time
+from collections import OrderedDict
+
+# A thread safe least recently used cache holding at most max_size entries.
+# Entries older than ttl seconds are treated as missing. A max_size of 0 disables the cache.
+# If max_bytes is given, the least recently used entries are also evicted once the sizes of all entries,
+# as estimated by sizeof(value), add up to more than it.
+class LRUCache:
+  def __init__(self, max_size, ttl=None, max_bytes=None, sizeof=None):
+    self.max_size = max_size
+    self.ttl = ttl
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+
+    self._sizeof = sizeof
+    self._bytes = 0
+    self._entries = OrderedDict() # key -> [value, expires, size]
+    self._lock = threading.Lock()
+
+  def get(self, key, default=None):
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None and entry[1] is not None and entry[1] < time.monotonic():
+        self._remove(key)
+        entry = None
+
+      if entry is None:
+        self.misses += 1
+        return default
+
+      self.hits += 1
+      self._entries.move_to_end(key)
+      return entry[0]
+
+  def put(self, key, value):
+    if self.max_size < 1:
+      return
+
+    expires = time.monotonic() + self.ttl if self.ttl is not None else None
+    size = self._sizeof(value) if self.max_bytes is not None else 0
+    if self.max_bytes is not None and size > self.max_bytes:
+      return
+
+    with self._lock:
+      self._remove(key)
+      self._entries[key] = [value, expires, size]
+      self._bytes += size
+      while len(self._entries) > self.max_size or (self.max_bytes is not None and self._bytes > self.max_bytes):
+        self._remove(next(iter(self._entries)))
+
+  def discard(self, key):
+    with self._lock:
+      self._remove(key)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._bytes = 0
+
+  def stats(self):
+    with self._lock:
+      return {
+        'hits': self.hits,
+        'misses': self.misses,
+        'size': len(self._entries),
+        'max_size': self.max_size,
+        'bytes': self._bytes,
+        'max_bytes': self.max_bytes
+      }
+
+  # Must be called with the lock held
+  def _remove(self, key):
+    entry = self._entries.pop(key, None)
+    if entry is not None:
+      self._bytes -= entry[2]
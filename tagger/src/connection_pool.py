@@ -0,0 +1,145 @@
+import threading
+import time
+from collections import deque
+
+import psycopg2
+import psycopg2.extensions
+from TMVException import TMVException
+
+# A bounded, thread safe pool of psycopg2 connections.
+#
+# * At most max_size connections are open at any time. Checking out a connection
+#   while all of them are in use blocks for up to checkout_timeout seconds.
+# * min_size connections are opened up front, and idle connections above min_size
+#   are closed once they have been idle for more than idle_timeout seconds.
+# * Connections that have been idle for more than health_check_interval seconds
+#   are pinged with 'SELECT 1' before being handed out, and replaced if broken.
+class ConnectionPool:
+  def __init__(self, connect, min_size, max_size, idle_timeout, checkout_timeout, health_check_interval):
+    if max_size < 1 or min_size < 0 or min_size > max_size:
+      raise ValueError('Invalid connection pool size (min: {}, max: {})'.format(min_size, max_size))
+
+    self._connect = connect
+    self.min_size = min_size
+    self.max_size = max_size
+    self.idle_timeout = idle_timeout
+    self.checkout_timeout = checkout_timeout
+    self.health_check_interval = health_check_interval
+
+    self._idle = deque() # [conn, last_used], most recently used last
+    self._size = 0
+    self._closed = False
+    self._cond = threading.Condition()
+
+    try:
+      for _ in range(min_size):
+        self._idle.append([connect(), time.monotonic()])
+        self._size += 1
+    except BaseException:
+      for conn, _ in self._idle:
+        self._close(conn)
+      raise
+
+  def getconn(self):
+    deadline = time.monotonic() + self.checkout_timeout
+
+    with self._cond:
+      while True:
+        if self._closed:
+          raise TMVException(TMVException.ID_DB_CONNECTION, 'Connection pool is closed')
+
+        self._reap_idle()
+        if len(self._idle) > 0:
+          conn, last_used = self._idle.pop()
+          break
+        if self._size < self.max_size:
+          self._size += 1
+          conn, last_used = None, None
+          break
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+          raise TMVException(TMVException.ID_DB_CONNECTION, 'Timed out waiting for a database connection')
+        self._cond.wait(remaining)
+
+    # Connecting and health checking happens outside of the lock
+    try:
+      if conn is not None and not self._is_healthy(conn, last_used):
+        self._close(conn)
+        conn = None
+      if conn is None:
+        conn = self._connect()
+    except BaseException:
+      with self._cond:
+        self._size -= 1
+        self._cond.notify()
+      raise
+
+    return conn
+
+  def putconn(self, conn):
+    try:
+      if not conn.closed and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        conn.rollback()
+      if not conn.closed and conn.autocommit:
+        conn.autocommit = False
+      reusable = not conn.closed
+    except psycopg2.Error:
+      reusable = False
+
+    with self._cond:
+      if reusable and not self._closed:
+        self._idle.append([conn, time.monotonic()])
+      else:
+        self._size -= 1
+        self._close(conn)
+      self._cond.notify()
+
+  def closeall(self):
+    with self._cond:
+      self._closed = True
+      while len(self._idle) > 0:
+        conn, _ = self._idle.popleft()
+        self._size -= 1
+        self._close(conn)
+      self._cond.notify_all()
+
+  def stats(self):
+    with self._cond:
+      return {
+        'size': self._size,
+        'idle': len(self._idle),
+        'min_size': self.min_size,
+        'max_size': self.max_size
+      }
+
+  # Must be called with the lock held. The least recently used connections are at the front.
+  def _reap_idle(self):
+    now = time.monotonic()
+    while len(self._idle) > 0 and self._size > self.min_size and now - self._idle[0][1] > self.idle_timeout:
+      conn, _ = self._idle.popleft()
+      self._size -= 1
+      self._close(conn)
+
+  def _is_healthy(self, conn, last_used):
+    if conn.closed:
+      return False
+    if time.monotonic() - last_used < self.health_check_interval:
+      return True
+
+    try:
+      cur = conn.cursor()
+      try:
+        cur.execute('SELECT 1')
+      finally:
+        cur.close()
+      conn.rollback()
+      return True
+    except psycopg2.Error:
+      return False
+
+  def _close(self, conn):
+    try:
+      conn.close()
+    except psycopg2.Error:
+      pass
@@ -1,15 +1,365 @@
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+import sys
+import threading
+import time
 import dotenv
+import metrics
+from bitmap_index import BitmapIndex
+from cache import LRUCache
+from connection_pool import ConnectionPool
 from TMVException import TMVException
-from collections import Counter
 
-def open_connection():
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+# Times every statement, labelled by the name of the function issuing it and the SQL verb ('SELECT', 'INSERT', ...).
+# Function names are a fixed set, so they're safe to use as labels, unlike the statements themselves.
+class _TimedCursor(psycopg2.extensions.cursor):
+  def execute(self, query, vars=None):
+    return self._timed(_statement_labels(sys._getframe(1), query), query, vars)
+
+  # Same as execute, but prepares the statement on the connection the first time it's run there and executes it by name
+  # afterwards, so Postgres only parses and plans it once per connection. Only for statements without a server side cursor.
+  #
+  # Statements are told apart by their SQL, so anything with a fixed shape can use this. Once a connection has prepared
+  # TMV_DB_PREPARED_STATEMENTS statements, anything new is executed as plain SQL instead.
+  #
+  # Not for searches: after five executions Postgres may switch a prepared statement to a generic plan, which doesn't know
+  # the LIKE patterns and so can't use the prefix indexes for them (see compile_term). Searches are planned every time instead.
+  def execute_prepared(self, query, vars=()):
+    labels = _statement_labels(sys._getframe(1), query)
+    conn = self.connection
+    name = conn.prepared.get(query)
+    if name is None:
+      if len(conn.prepared) >= _max_prepared_statements():
+        return self._timed(labels, query, vars)
+      conn.prepared_count += 1
+      name = 'tmv_stmt_' + str(conn.prepared_count)
+      self._timed((labels[0], 'PREPARE'), 'PREPARE ' + name + ' AS ' + _positional_parameters(query), None)
+      conn.prepared[query] = name
+
+    try:
+      return self._timed(labels, 'EXECUTE ' + name + (' (' + ', '.join(['%s'] * len(vars)) + ')' if len(vars) > 0 else ''), vars)
+    except psycopg2.errors.InvalidSqlStatementName:
+      # Somebody deallocated it behind our back, prepare it again next time
+      conn.prepared.pop(query, None)
+      raise
+
+  def _timed(self, labels, query, vars):
+    start = time.perf_counter()
+    try:
+      return super().execute(query, vars)
+    except BaseException:
+      metrics.DB_STATEMENT_ERRORS.inc(labels)
+      raise
+    finally:
+      metrics.DB_STATEMENT_SECONDS.observe(labels, time.perf_counter() - start)
+      if self.rowcount > 0:
+        metrics.DB_STATEMENT_ROWS.inc(labels, self.rowcount)
+
+# Keeps track of the statements prepared on it by _TimedCursor.execute_prepared.
+# Prepared statements live as long as the session, no matter if the transaction preparing them commits or not.
+class _Connection(psycopg2.extensions.connection):
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.prepared = {} # SQL -> statement name
+    self.prepared_count = 0
+
+def _statement_labels(frame, query):
+  return (frame.f_code.co_name, query.lstrip().split(None, 1)[0].upper())
+
+def _max_prepared_statements():
+  return int(dotenv.read()['TMV_DB_PREPARED_STATEMENTS'])
+
+# PREPARE takes $1, $2, ... instead of psycopg2's %s
+def _positional_parameters(query):
+  parts = query.split('%%')
+  count = 0
+  for i, part in enumerate(parts):
+    pieces = part.split('%s')
+    for j in range(1, len(pieces)):
+      count += 1
+      pieces[j] = '$' + str(count) + pieces[j]
+    parts[i] = ''.join(pieces)
+  return '%'.join(parts)
+
+def _connect():
   try:
     env = dotenv.read()
-    return psycopg2.connect(dbname=env['TMV_DB_NAME'], user=env['TMV_DB_USER'], password=env['TMV_DB_PASSWORD'], host=env['TMV_DB_NETWORK_ALIAS'], port=5432)
+    return psycopg2.connect(dbname=env['TMV_DB_NAME'], user=env['TMV_DB_USER'], password=env['TMV_DB_PASSWORD'], host=env['TMV_DB_NETWORK_ALIAS'], port=5432, connection_factory=_Connection, cursor_factory=_TimedCursor)
   except psycopg2.OperationalError as e:
     raise TMVException(TMVException.ID_DB_CONNECTION, 'Failed to connect to database')
 
+def get_pool():
+  global _POOL
+  if _POOL is not None:
+    return _POOL
+
+  with _POOL_LOCK:
+    if _POOL is None:
+      env = dotenv.read()
+      _POOL = ConnectionPool(
+        _connect,
+        min_size=int(env['TMV_DB_POOL_MIN_SIZE']),
+        max_size=int(env['TMV_DB_POOL_MAX_SIZE']),
+        idle_timeout=float(env['TMV_DB_POOL_IDLE_TIMEOUT']),
+        checkout_timeout=float(env['TMV_DB_POOL_CHECKOUT_TIMEOUT']),
+        health_check_interval=float(env['TMV_DB_POOL_HEALTH_CHECK_INTERVAL'])
+      )
+  return _POOL
+
+def close_pool():
+  global _POOL
+  with _POOL_LOCK:
+    if _POOL is not None:
+      _POOL.closeall()
+      _POOL = None
+
+def _pool_connections():
+  pool = _POOL
+  if pool is None:
+    return {}
+  stats = pool.stats()
+  return {('idle',): stats['idle'], ('in_use',): stats['size'] - stats['idle']}
+
+metrics.register(metrics.Gauge('tmv_db_pool_connections', 'Open connections of the database connection pool', _pool_connections, ('state',)))
+
+# Borrows a connection from the pool. Must be given back with close_connection()
+def open_connection():
+  start = time.perf_counter()
+  try:
+    return get_pool().getconn()
+  finally:
+    metrics.DB_ACQUIRE_SECONDS.observe((), time.perf_counter() - start)
+
+# Returns the connection to the pool, rolling back anything left uncommitted
+def close_connection(conn):
+  _reset_pending_tag_ids()
+  get_pool().putconn(conn)
+
+def _commit(conn):
+  conn.commit()
+  _publish_pending_tag_ids()
+  _bump_search_generation()
+
+_TAG_ID_CACHE = None
+_TAG_ID_CACHE_LOCK = threading.Lock()
+
+# Per process cache of multitag and valuetag IDs, keyed by ('multi', value) and ('value', name, value).
+# Other tagger processes can't invalidate it, so entries expire after TMV_TAGGER_TAG_ID_CACHE_TTL seconds.
+def get_tag_id_cache():
+  global _TAG_ID_CACHE
+  if _TAG_ID_CACHE is not None:
+    return _TAG_ID_CACHE
+
+  with _TAG_ID_CACHE_LOCK:
+    if _TAG_ID_CACHE is None:
+      env = dotenv.read()
+      _TAG_ID_CACHE = LRUCache(int(env['TMV_TAGGER_TAG_ID_CACHE_SIZE']), float(env['TMV_TAGGER_TAG_ID_CACHE_TTL']))
+  return _TAG_ID_CACHE
+
+# Tag IDs seen by a transaction are only cached once it commits, so that a rollback can't leave IDs of tags that don't exist behind.
+# Every database call runs on a single thread, so the pending changes are kept per thread.
+_PENDING_TAG_IDS = threading.local()
+
+# Bumped by every invalidation. A transaction that read IDs before an invalidation may have read an ID the invalidation
+# made stale (a rename committing while it ran), so it doesn't publish any of them.
+_TAG_ID_GENERATION = 0
+_TAG_ID_GENERATION_LOCK = threading.Lock()
+
+def _bump_tag_id_generation():
+  global _TAG_ID_GENERATION
+  with _TAG_ID_GENERATION_LOCK:
+    _TAG_ID_GENERATION += 1
+
+def _pending_tag_ids():
+  if not hasattr(_PENDING_TAG_IDS, 'cached'):
+    _reset_pending_tag_ids()
+  return _PENDING_TAG_IDS
+
+def _reset_pending_tag_ids():
+  _PENDING_TAG_IDS.cached = {}
+  _PENDING_TAG_IDS.invalidated = set()
+  _PENDING_TAG_IDS.generation = None
+
+# generation is the one from before the ID was read
+def _cache_tag_id(key, tag_id, generation):
+  pending = _pending_tag_ids()
+  pending.invalidated.discard(key)
+  pending.cached[key] = tag_id
+  if pending.generation is None or generation < pending.generation:
+    pending.generation = generation
+
+# Invalidated right away, and again on commit in case another thread cached the old ID in the meantime
+def _invalidate_tag_id(key):
+  pending = _pending_tag_ids()
+  pending.cached.pop(key, None)
+  pending.invalidated.add(key)
+  _bump_tag_id_generation()
+  get_tag_id_cache().discard(key)
+
+def _publish_pending_tag_ids():
+  pending = _pending_tag_ids()
+  cache = get_tag_id_cache()
+  if len(pending.invalidated) > 0:
+    _bump_tag_id_generation()
+  for key in pending.invalidated:
+    cache.discard(key)
+
+  # Holding the lock while publishing makes any invalidation either bump the generation before the check, or discard after the put
+  with _TAG_ID_GENERATION_LOCK:
+    if pending.generation == _TAG_ID_GENERATION:
+      for key in pending.cached:
+        cache.put(key, pending.cached[key])
+  _reset_pending_tag_ids()
+
+# Raised when a row the transaction is about to use has been deleted by another transaction since it was looked up
+class _StaleTagIds(Exception):
+  pass
+
+# A cached ID is stale if another tagger process deleted the tag, which Postgres reports as a foreign key violation.
+# The _upsert_* functions raise _StaleTagIds if a row they didn't insert was deleted before they could read its ID,
+# and the _insert_*_bridge_rows functions if a tag no longer has the name its ID was looked up by.
+# The cache is then dropped, and the work redone once with IDs read from the database.
+def _retry_on_stale_tag_ids(conn, work):
+  try:
+    return work()
+  except (psycopg2.errors.ForeignKeyViolation, _StaleTagIds):
+    conn.rollback()
+    _reset_pending_tag_ids()
+    get_tag_id_cache().clear()
+    return work()
+
+# Postgres breaks a deadlock by aborting one of the transactions in it. Untagging locks what it may delete up front
+# (see _lock_removal_candidates), which avoids the deadlocks known to happen, and whatever is left is retried here.
+_DEADLOCK_ATTEMPTS = 3
+
+def _retry_on_deadlock(conn, work):
+  for attempt in range(_DEADLOCK_ATTEMPTS):
+    try:
+      return work()
+    except psycopg2.errors.DeadlockDetected:
+      conn.rollback()
+      _reset_pending_tag_ids()
+      if attempt == _DEADLOCK_ATTEMPTS - 1:
+        raise
+
+# Cached search results are keyed on the generation they were read in. Every committed write starts a new
+# generation, which makes all earlier results unreachable, and they're evicted as the cache fills up again.
+# As with the tag ID cache, writes by other tagger processes aren't seen until TMV_TAGGER_SEARCH_CACHE_TTL has passed.
+_SEARCH_GENERATION = 0
+_SEARCH_GENERATION_LOCK = threading.Lock()
+
+_SEARCH_CACHE = None
+_SEARCH_CACHE_LOCK = threading.Lock()
+
+def _bump_search_generation():
+  global _SEARCH_GENERATION
+  with _SEARCH_GENERATION_LOCK:
+    _SEARCH_GENERATION += 1
+
+# Values are (values, last_id) tuples
+def _search_result_size(result):
+  return sys.getsizeof(result[0]) + sum(sys.getsizeof(v) for v in result[0])
+
+def get_search_cache():
+  global _SEARCH_CACHE
+  if _SEARCH_CACHE is not None:
+    return _SEARCH_CACHE
+
+  with _SEARCH_CACHE_LOCK:
+    if _SEARCH_CACHE is None:
+      env = dotenv.read()
+      _SEARCH_CACHE = LRUCache(
+        int(env['TMV_TAGGER_SEARCH_CACHE_SIZE']),
+        float(env['TMV_TAGGER_SEARCH_CACHE_TTL']),
+        max_bytes=int(env['TMV_TAGGER_SEARCH_CACHE_MAX_BYTES']),
+        sizeof=_search_result_size
+      )
+  return _SEARCH_CACHE
+
+# The order and repetition of terms doesn't change the result, so neither changes the key
+def _search_cache_key(generation, query, limit, after_id):
+  return (
+    generation,
+    tuple(sorted(set(query['positive']))),
+    tuple(sorted(set(query['negative']))),
+    tuple(sorted(set(query['pos_value']))),
+    tuple(sorted(set(query['neg_value']))),
+    limit,
+    after_id
+  )
+
+# With TMV_TAGGER_SEARCH_ENGINE set to 'bitmap', searches are answered by an in memory BitmapIndex instead of the database.
+# The index is loaded on startup, and every write through this process refreshes the tagged values it touched.
+# Writes through other tagger processes are picked up by reloading it every TMV_TAGGER_SEARCH_ENGINE_RELOAD_INTERVAL seconds.
+_SEARCH_ENGINE = None
+
+def load_search_engine():
+  global _SEARCH_ENGINE
+  env = dotenv.read()
+  engine = env['TMV_TAGGER_SEARCH_ENGINE']
+  if engine == 'sql':
+    return
+  if engine != 'bitmap':
+    raise TMVException(TMVException.ID_SEARCH_ENGINE, 'Unknown search engine \'{}\''.format(engine))
+
+  conn = None
+  try:
+    index = _SEARCH_ENGINE if _SEARCH_ENGINE is not None else BitmapIndex()
+    conn = open_connection()
+    index.load(conn, get_table_names(), int(env['TMV_TAGGER_STREAM_BATCH_SIZE']))
+    _SEARCH_ENGINE = index
+  finally:
+    if conn:
+      close_connection(conn)
+
+# Called after a write has been committed, so the refresh reads what it wrote
+def _refresh_search_engine(conn, tagged_ids):
+  if _SEARCH_ENGINE is None:
+    return
+
+  cur = None
+  try:
+    cur = conn.cursor()
+    _SEARCH_ENGINE.refresh(cur, get_table_names(), tagged_ids)
+    conn.commit()
+  except psycopg2.Error as e:
+    # The write itself went through, the index catches up on its next reload
+    print('Failed to refresh the search engine: {}'.format(e))
+  finally:
+    if cur:
+      cur.close()
+
+def _search_engine_ids_with_multitags(tags):
+  if _SEARCH_ENGINE is None:
+    return []
+  return [tagged_id for tag in tags for tagged_id in _SEARCH_ENGINE.ids_with_multitag(tag)]
+
+# Tags are (name, value) tuples
+def _search_engine_ids_with_valuetags(tags):
+  if _SEARCH_ENGINE is None:
+    return []
+  return [tagged_id for tag in tags for tagged_id in _SEARCH_ENGINE.ids_with_valuetag(tag[0], tag[1])]
+
+def _search_engine_query(query):
+  return {
+    'positive': query['positive'],
+    'negative': query['negative'],
+    'pos_value': [parse_value_query(q) for q in query['pos_value']],
+    'neg_value': [parse_value_query(q) for q in query['neg_value']]
+  }
+
+def get_stats():
+  return {
+    'tag_id_cache': get_tag_id_cache().stats(),
+    'search_cache': get_search_cache().stats(),
+    'search_engine': _SEARCH_ENGINE.stats() if _SEARCH_ENGINE is not None else None,
+    'orphan_sweeper': get_orphan_sweeper_stats() if _orphans_deferred() else None
+  }
+
 def get_table_names():
   env = dotenv.read()
   schema = env['TMV_DB_SCHEMA_NAME']
@@ -23,6 +373,9 @@ def get_table_names():
   retval['tagged_valuetags']    = schema + '.' + env['TMV_DB_TAGGED_VALUETAGS_BRIDGE_TABLE_NAME']
 
   retval['multitags_multitags'] = schema + '.' + env['TMV_DB_MULTITAGS_MULTITAGS_BRIDGE_TABLE_NAME']
+  retval['multitags_closure']   = schema + '.' + env['TMV_DB_MULTITAGS_CLOSURE_TABLE_NAME']
+
+  retval['migrations']          = schema + '.' + env['TMV_DB_MIGRATIONS_TABLE_NAME']
 
   return retval
 
@@ -68,7 +421,7 @@ def create_tables():
     if cur:
       cur.close()
     if conn:
-      conn.close()
+      close_connection(conn)
 
 def query_is_value_query(query):
   if not query.endswith('}'):
@@ -112,150 +465,314 @@ def split_query(query):
 
   return retval
 
-def get_query_ids(value, cur, names, forbidden_ids):
-  forbidden_ids_string = '(' + ','.join(str(i) for i in forbidden_ids) + ')'
-  comparator = 'LIKE' if '%' in value else '='
-
-  cur.execute("""
-SELECT DISTINCT t.id FROM """ + names['tagged'] + """ AS t WHERE """ + ('NOT t.id IN {} AND '.format(forbidden_ids_string) if len(forbidden_ids) > 0 else '') + """t.id IN (
-  SELECT DISTINCT t.id FROM """ + names['tagged'] + """ AS t
-    JOIN """ + names['tagged_multitags'] + """ AS mtt ON mtt.tagged_id = t.id
-    JOIN """ + names['multitags'] + """ AS mt ON mtt.tag_id = mt.id
-    WHERE mt.value """ + comparator + """ %s
-) OR t.id IN (
-  SELECT DISTINCT t.id FROM """ + names['tagged'] + """ AS t
-    JOIN """ + names['tagged_valuetags'] + """ AS vtt ON vtt.tagged_id = t.id
-    JOIN """ + names['valuetags'] + """ AS vt ON vtt.tag_id = vt.id
-    WHERE CONCAT(vt.name, CAST(vt.value AS text)) """ + comparator + """ %s
-)""", (value, value))
-
-  retval = []
-  row = cur.fetchone()
-  while row:
-    retval.append(row[0])
-    row = cur.fetchone()
-
-  return retval
+def parse_value_query(query):
+  start_index = query.rfind('{')
+  name = query[:start_index]
+  val = query[start_index + 1:-1].strip()
 
-def get_value_query_ids(value, cur, names, forbidden_ids):
-  forbidden_ids_string = '(' + ','.join(str(i) for i in forbidden_ids) + ')'
-  [name, value] = value.split('{')
-  comparator = value[0]
-  value = value[1:-1]
-  if not value[0].isnumeric():
-    comparator += value[0]
-    value = value[1:]
-  value = int(value)
-
-  cur.execute("""
-SELECT DISTINCT t.id FROM """ + names['tagged'] + """ AS t""" + (' WHERE NOT t.id IN {}'.format(forbidden_ids_string) if len(forbidden_ids) > 0 else '') + """
-  JOIN """ + names['tagged_valuetags'] + """ AS vtt ON vtt.tagged_id = t.id
-  JOIN """ + names['valuetags'] + """ AS vt ON vtt.tag_id = vt.id
-  WHERE vt.name = %s AND vt.value """ + comparator + """ %s
-""", (name, value))
-
-  retval = []
-  row = cur.fetchone()
-  while row:
-    retval.append(row[0])
-    row = cur.fetchone()
-  return retval
+  for comparator in ['>=', '<=', '!=', '<>', '>', '<']:
+    if val.startswith(comparator):
+      return name, comparator, int(val[len(comparator):].strip())
+
+# Returns a SELECT statement (and its parameters) yielding the IDs of every tagged value matching the given term
+# Must match migrations._FULLNAME, or the fullname indexes won't be used
+def _fullname(alias):
+  return '(' + alias + '.name || CAST(' + alias + '.value AS text))'
+
+def compile_term(term, names):
+  if query_is_value_query(term):
+    name, comparator, value = parse_value_query(term)
+    return ("""SELECT vtt.tagged_id FROM """ + names['tagged_valuetags'] + """ AS vtt
+  JOIN """ + names['valuetags'] + """ AS vt ON vt.id = vtt.tag_id
+  WHERE vt.name = %s AND vt.value """ + comparator + """ %s""", [name, value])
+
+  if '%' in term:
+    # Resolve the matching tags on their own first, so that the trigram and pattern indexes (see migrations.py)
+    # drive the lookup instead of the pattern being evaluated per bridge row
+    return ("""SELECT mtt.tagged_id FROM """ + names['tagged_multitags'] + """ AS mtt
+  WHERE mtt.tag_id IN (SELECT mt.id FROM """ + names['multitags'] + """ AS mt WHERE mt.value LIKE %s)
+UNION ALL
+SELECT vtt.tagged_id FROM """ + names['tagged_valuetags'] + """ AS vtt
+  WHERE vtt.tag_id IN (SELECT vt.id FROM """ + names['valuetags'] + """ AS vt WHERE """ + _fullname('vt') + """ LIKE %s)""", [term, term])
+
+  return ("""SELECT mtt.tagged_id FROM """ + names['tagged_multitags'] + """ AS mtt
+  JOIN """ + names['multitags'] + """ AS mt ON mt.id = mtt.tag_id
+  WHERE mt.value = %s
+UNION ALL
+SELECT vtt.tagged_id FROM """ + names['tagged_valuetags'] + """ AS vtt
+  JOIN """ + names['valuetags'] + """ AS vt ON vt.id = vtt.tag_id
+  WHERE """ + _fullname('vt') + """ = %s""", [term, term])
 
 # abc -def ghi:% jkl{>10} -mno{<=5}
 # ============ LEADS TO ====================
-# A = SELECT DISTINCT t.id FROM tmv.tagged AS t WHERE t.id IN (
-#   SELECT DISTINCT t.id FROM tmv.tagged AS t
-#     JOIN tmv.tagged_tags AS mtt ON mtt.tagged_id = t.id
-#     JOIN tmv.tags AS mt ON mtt.tag_id = mt.id
+# t.id IN (
+#   SELECT mtt.tagged_id FROM tmv.tagged_tags AS mtt
+#     JOIN tmv.tags AS mt ON mt.id = mtt.tag_id
 #     WHERE mt.value = 'abc'
-# ) OR t.id IN (
-#   SELECT DISTINCT t.id FROM tmv.tagged AS t
-#     JOIN tmv.tagged_valuetags AS vtt ON vtt.tagged_id = t.id
-#     JOIN tmv.valuetags AS vt ON vtt.tag_id = vt.id
-#     WHERE CONCAT(vt.name, CAST(vt.value AS text)) = 'abc'
-# )
-#
-# B = SELECT DISTINCT t.id FROM tmv.tagged AS t WHERE t.id IN (
-#   SELECT DISTINCT t.id FROM tmv.tagged AS t
-#     JOIN tmv.tagged_tags AS mtt ON mtt.tagged_id = t.id
-#     JOIN tmv.tags AS mt ON mtt.tag_id = mt.id
-#     WHERE mt.value = 'def'
-# ) OR t.id IN (
-#   SELECT DISTINCT t.id FROM tmv.tagged AS t
-#     JOIN tmv.tagged_valuetags AS vtt ON vtt.tagged_id = t.id
-#     JOIN tmv.valuetags AS vt ON vtt.tag_id = vt.id
-#     WHERE CONCAT(vt.name, CAST(vt.value AS text)) = 'def'
+#   UNION ALL
+#   SELECT vtt.tagged_id FROM tmv.tagged_valuetags AS vtt
+#     JOIN tmv.valuetags AS vt ON vt.id = vtt.tag_id
+#     WHERE (vt.name || CAST(vt.value AS text)) = 'abc'
+# ) AND t.id IN (
+#   SELECT mtt.tagged_id FROM tmv.tagged_tags AS mtt
+#     WHERE mtt.tag_id IN (SELECT mt.id FROM tmv.tags AS mt WHERE mt.value LIKE 'ghi:%')
+#   UNION ALL
+#   SELECT vtt.tagged_id FROM tmv.tagged_valuetags AS vtt
+#     WHERE vtt.tag_id IN (SELECT vt.id FROM tmv.valuetags AS vt WHERE (vt.name || CAST(vt.value AS text)) LIKE 'ghi:%')
+# ) AND t.id IN (
+#   SELECT vtt.tagged_id FROM tmv.tagged_valuetags AS vtt
+#     JOIN tmv.valuetags AS vt ON vt.id = vtt.tag_id
+#     WHERE vt.name = 'jkl' AND vt.value > 10
+# ) AND NOT EXISTS (
+#   SELECT 1 FROM (<same as 'abc', but with 'def'>) AS n WHERE n.tagged_id = t.id
+# ) AND NOT EXISTS (
+#   SELECT 1 FROM (<same as 'jkl', but with 'mno' and <= 5>) AS n WHERE n.tagged_id = t.id
 # )
 #
-# C = SELECT DISTINCT t.id FROM tmv.tagged AS t WHERE t.id IN (
-#   SELECT DISTINCT t.id FROM tmv.tagged AS t
-#     JOIN tmv.tagged_tags AS mtt ON mtt.tagged_id = t.id
-#     JOIN tmv.tags AS mt ON mtt.tag_id = mt.id
-#     WHERE mt.value LIKE 'ghi:%'
-# ) OR t.id IN (
-#   SELECT DISTINCT t.id FROM tmv.tagged AS t
-#     JOIN tmv.tagged_valuetags AS vtt ON vtt.tagged_id = t.id
-#     JOIN tmv.valuetags AS vt ON vtt.tag_id = vt.id
-#     WHERE CONCAT(vt.name, CAST(vt.value AS text)) LIKE 'ghi:%'
-# )
-#
-# D = SELECT DISTINCT t.id FROM tmv.tagged AS t
-#   JOIN tmv.tagged_valuetags AS vtt ON vtt.tagged_id = t.id
-#   JOIN tmv.valuetags AS vt ON vtt.tag_id = vt.id
-#   WHERE vt.name = 'jkl' AND vt.value > 10
-#
-# E = SELECT DISTINCT t.id FROM tmv.tagged AS t
-#   JOIN tmv.tagged_valuetags AS vtt ON vtt.tagged_id = t.id
-#   JOIN tmv.valuetags AS vt ON vtt.tag_id = vt.id
-#   WHERE vt.name = 'mno' AND vt.value <= 10
-#
-# Return list of distinct IDs that are in A & C & D, but also not in B or E
-def search(query):
+# The '<name><value>' expression is indexed as is, see migrations.py.
+# Postgres turns these into semi and anti joins, so the whole search is answered by a single statement.
+# Returns None if the query has no positive terms, since nothing can match it.
+def compile_search(query, names):
+  positive = query['positive'] + query['pos_value']
+  negative = query['negative'] + query['neg_value']
+  if len(positive) == 0:
+    return None
+
+  conditions = []
+  params = []
+  for term in positive:
+    sql, term_params = compile_term(term, names)
+    conditions.append('t.id IN (\n' + sql + '\n)')
+    params += term_params
+  for term in negative:
+    sql, term_params = compile_term(term, names)
+    conditions.append('NOT EXISTS (\n  SELECT 1 FROM (\n' + sql + '\n) AS n WHERE n.tagged_id = t.id\n)')
+    params += term_params
+
+  return ' AND '.join(conditions), params
+
+# Pages are keyset paginated on tagged.id: a page holds the first <limit> matches with an ID larger than <after_id>
+def _search_statement(where, params, names, limit, after_id):
+  if limit is None:
+    return 'SELECT t.id, t.value FROM ' + names['tagged'] + ' AS t WHERE ' + where, params
+
+  if after_id is not None:
+    where += ' AND t.id > %s'
+    params = params + [after_id]
+  # One extra row tells us whether there's another page
+  return 'SELECT t.id, t.value FROM ' + names['tagged'] + ' AS t WHERE ' + where + ' ORDER BY t.id LIMIT %s', params + [limit + 1]
+
+# Returns (values, last_id), where last_id is the ID to continue from if there are more results than <limit>, and None otherwise
+def search(query, limit=None, after_id=None):
   conn = None
   cur = None
   query = split_query(query)
+  if _SEARCH_ENGINE is not None:
+    return _SEARCH_ENGINE.search(_search_engine_query(query), limit, after_id)
+
+  # The generation has to be read before the search, so that a write committing while it runs makes the result stale
+  cache = get_search_cache()
+  cache_key = _search_cache_key(_SEARCH_GENERATION, query, limit, after_id)
+  cached = cache.get(cache_key)
+  if cached is not None:
+    return list(cached[0]), cached[1]
 
   try:
+    names = get_table_names()
+    compiled = compile_search(query, names)
+    if compiled is None:
+      return [], None
+    sql, params = _search_statement(compiled[0], compiled[1], names, limit, after_id)
+
     conn = open_connection()
     cur = conn.cursor()
-    names = get_table_names()
+    cur.execute(sql, params)
+    rows = cur.fetchall()
 
-    neg_ids = []
-    for q in query['negative']:
-      neg_ids = neg_ids + get_query_ids(q, cur, names, neg_ids)
-    for q in query['neg_value']:
-      neg_ids = neg_ids + get_value_query_ids(q, cur, names, neg_ids)
+    last_id = None
+    if limit is not None and len(rows) > limit:
+      rows = rows[:limit]
+      last_id = rows[-1][0]
 
-    ids = []
-    for q in query['positive']:
-      ids = ids + get_query_ids(q, cur, names, neg_ids)
-    for q in query['pos_value']:
-      ids = ids + get_value_query_ids(q, cur, names, neg_ids)
+    values = [row[1] for row in rows]
+    cache.put(cache_key, (tuple(values), last_id))
+    return values, last_id
+  finally:
+    if cur:
+      cur.close()
+    if conn:
+      close_connection(conn)
 
-    # Only keep IDs that were in all positive lists
-    pos_amount = len(query['positive']) + len(query['pos_value'])
-    id_counts = Counter(ids)
-    ids = [id for id in ids if id_counts[id] == pos_amount]
+# Same as search, but also returns how the search was answered. Always runs the SQL search, skipping the search cache
+# and the in memory search engine. Runs every statement twice (EXPLAIN ANALYZE and for real), so it's only for debugging.
+#
+# Returns (values, last_id, {
+#   'terms': [{'term': STRING, 'negated': BOOLEAN, 'sql': STRING, 'rows': INTEGER, 'ms': FLOAT}, ...],
+#   'sql': STRING,
+#   'ms': FLOAT,
+#   'plan': <EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) output>
+# })
+def explain_search(query, limit=None, after_id=None):
+  conn = None
+  cur = None
+  query = split_query(query)
 
-    if len(ids) == 0:
-      return []
+  try:
+    names = get_table_names()
+    conn = open_connection()
+    cur = conn.cursor()
+    retval = {'terms': [], 'sql': None, 'ms': None, 'plan': None}
+
+    # Every term on its own, to see which of them is expensive or matches a lot. A tagged value can match a term through
+    # several tags (and both tag kinds), so rows counts the distinct tagged values, like the search itself would
+    terms = [(term, False) for term in query['positive'] + query['pos_value']] + [(term, True) for term in query['negative'] + query['neg_value']]
+    for term, negated in terms:
+      sql, params = compile_term(term, names)
+      start = time.perf_counter()
+      cur.execute('SELECT COUNT(DISTINCT term.tagged_id) FROM (\n' + sql + '\n) AS term', params)
+      rows = cur.fetchone()[0]
+      retval['terms'].append({
+        'term': term,
+        'negated': negated,
+        'sql': cur.mogrify(sql, params).decode('utf-8'),
+        'rows': rows,
+        'ms': (time.perf_counter() - start) * 1000
+      })
+
+    compiled = compile_search(query, names)
+    if compiled is None:
+      return [], None, retval
+    sql, params = _search_statement(compiled[0], compiled[1], names, limit, after_id)
+    retval['sql'] = cur.mogrify(sql, params).decode('utf-8')
+
+    cur.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + sql, params)
+    retval['plan'] = cur.fetchone()[0]
+
+    start = time.perf_counter()
+    cur.execute(sql, params)
+    rows = cur.fetchall()
+    retval['ms'] = (time.perf_counter() - start) * 1000
+
+    last_id = None
+    if limit is not None and len(rows) > limit:
+      rows = rows[:limit]
+      last_id = rows[-1][0]
+    return [row[1] for row in rows], last_id, retval
+  finally:
+    if cur:
+      cur.close()
+    if conn:
+      close_connection(conn)
 
-    ids_string = '(' + ','.join(str(i) for i in ids) + ')'
-    cur.execute('SELECT t.value FROM ' + names['tagged'] + ' AS t WHERE t.id IN {}'.format(ids_string))
+# Counts the multitags and value tag names of every tagged value matching the query, returning the <top> most common of each.
+# The matches are found with the same statement as search, and everything is counted in a single statement.
+# Always runs in the database, also when searches are answered by the in memory search engine.
+#
+# With <sample_percent>, only that percentage of the tagged table's pages is looked at (TABLESAMPLE SYSTEM),
+# and the counts are scaled up to estimates for the whole result set. That keeps facets of huge result sets cheap,
+# at the cost of rarely used tags possibly missing from them.
+#
+# Returns {
+#   'total': INTEGER,
+#   'sampled': BOOLEAN,
+#   'multi_tags': [{'tag': STRING, 'count': INTEGER}, ...],
+#   'value_tags': [{'name': STRING, 'count': INTEGER}, ...]
+# }
+def search_facets(query, top, sample_percent=None):
+  conn = None
+  cur = None
+  query = split_query(query)
+  retval = {'total': 0, 'sampled': sample_percent is not None, 'multi_tags': [], 'value_tags': []}
 
-    retval = []
-    row = cur.fetchone()
-    while row:
-      retval.append(row[0])
-      row = cur.fetchone()
+  try:
+    names = get_table_names()
+    compiled = compile_search(query, names)
+    if compiled is None:
+      return retval
+    where, params = compiled
+
+    sample = ''
+    if sample_percent is not None:
+      sample = ' TABLESAMPLE SYSTEM (%s)'
+      params = [sample_percent] + params
+
+    # The matches are materialized, so the search itself only runs once for the three counts
+    sql = """
+WITH matches AS MATERIALIZED (
+  SELECT t.id FROM """ + names['tagged'] + """ AS t""" + sample + """ WHERE """ + where + """
+)
+SELECT 'total', NULL, COUNT(*) FROM matches
+UNION ALL
+(SELECT 'multi', mt.value, f.n FROM (
+  SELECT mtt.tag_id, COUNT(*) AS n FROM matches AS m
+    JOIN """ + names['tagged_multitags'] + """ AS mtt ON mtt.tagged_id = m.id
+    GROUP BY mtt.tag_id ORDER BY n DESC, mtt.tag_id LIMIT %s
+) AS f JOIN """ + names['multitags'] + """ AS mt ON mt.id = f.tag_id)
+UNION ALL
+(SELECT 'value', vt.name, COUNT(DISTINCT vtt.tagged_id) AS n FROM matches AS m
+  JOIN """ + names['tagged_valuetags'] + """ AS vtt ON vtt.tagged_id = m.id
+  JOIN """ + names['valuetags'] + """ AS vt ON vt.id = vtt.tag_id
+  GROUP BY vt.name ORDER BY n DESC, vt.name LIMIT %s)"""
 
+    conn = open_connection()
+    cur = conn.cursor()
+    cur.execute(sql, params + [top, top])
+
+    scale = 100 / sample_percent if sample_percent is not None else 1
+    for kind, name, count in cur.fetchall():
+      count = int(round(count * scale))
+      if kind == 'total':
+        retval['total'] = count
+      elif kind == 'multi':
+        retval['multi_tags'].append({'tag': name, 'count': count})
+      else:
+        retval['value_tags'].append({'name': name, 'count': count})
+
+    retval['multi_tags'].sort(key=lambda f: (-f['count'], f['tag']))
+    retval['value_tags'].sort(key=lambda f: (-f['count'], f['name']))
     return retval
   finally:
     if cur:
       cur.close()
     if conn:
-      conn.close()
+      close_connection(conn)
+
+# Generator yielding the search results in lists of at most <batch_size> values.
+# The results are read through a server side cursor, so they're never all in memory at once.
+def search_stream(query, batch_size):
+  conn = None
+  cur = None
+  query = split_query(query)
+
+  if _SEARCH_ENGINE is not None:
+    values = _SEARCH_ENGINE.search(_search_engine_query(query))[0]
+    for i in range(0, len(values), batch_size):
+      yield values[i:i + batch_size]
+    return
+
+  try:
+    names = get_table_names()
+    compiled = compile_search(query, names)
+    if compiled is None:
+      return
+    sql, params = _search_statement(compiled[0], compiled[1], names, None, None)
+
+    conn = open_connection()
+    cur = conn.cursor(name='tmv_search_stream')
+    cur.itersize = batch_size
+    cur.execute(sql, params)
+
+    rows = cur.fetchmany(batch_size)
+    while rows:
+      yield [row[1] for row in rows]
+      rows = cur.fetchmany(batch_size)
+  finally:
+    if cur:
+      cur.close()
+    if conn:
+      close_connection(conn)
 
+# Answers the request for every value with a fixed amount of queries, no matter how many values are asked for
 def get(tagged, value_tags, multi_tags):
   conn = None
   cur = None
@@ -265,142 +782,415 @@ def get(tagged, value_tags, multi_tags):
     cur = conn.cursor()
     names = get_table_names()
 
-    tagged_ids = []
-    for t in tagged:
-      cur.execute('SELECT id FROM ' + names['tagged'] + ' WHERE value = %s', (t,))
-      tagged_id = cur.fetchone()
-      if tagged_id:
-        tagged_ids.append([tagged_id[0], t])
-      else:
-        tagged_ids.append([None, t])
-
     retval = {}
-    for tagged_id in tagged_ids:
-      name = tagged_id[1]
-      id = tagged_id[0]
-      retval[name] = {}
-
-      if id is None:
-        if value_tags:
-          retval[name]['value'] = []
-        if multi_tags:
-          retval[name]['multi'] = []
-        continue
-
+    for t in tagged:
+      retval[t] = {}
       if value_tags:
-        # SELECT v.name, v.value FROM tmv.valuetags AS v, tmv.tagged_valuetags AS tv WHERE tv.tag_id = v.id AND tv.tagged_id = {tagged_id}
-        cur.execute('SELECT v.name, v.value FROM ' + names['valuetags'] + ' AS v, ' + names['tagged_valuetags'] + ' AS tv WHERE tv.tag_id = v.id AND tv.tagged_id = %s', (id,))
-        retval[name]['value'] = []
-        row = cur.fetchone()
-        while row:
-          retval[name]['value'].append({'name': row[0], 'value': row[1]})
-          row = cur.fetchone()
-
+        retval[t]['value'] = []
       if multi_tags:
-        # SELECT v.name, v.value FROM tmv.tags AS v, tmv.tagged_tags AS tv WHERE tv.tag_id = v.id AND tv.tagged_id = {tagged_id}
-        cur.execute('SELECT v.value FROM ' + names['multitags'] + ' AS v, ' + names['tagged_multitags'] + ' AS tv WHERE tv.tag_id = v.id AND tv.tagged_id = %s', (id,))
-        retval[name]['multi'] = []
-        row = cur.fetchone()
-        while row:
-          retval[name]['multi'].append(row[0])
-          row = cur.fetchone()
+        retval[t]['multi'] = []
+
+    cur.execute_prepared('SELECT id, value FROM ' + names['tagged'] + ' WHERE value = ANY(%s)', (list(retval),))
+    values_by_id = dict(cur.fetchall())
+    if len(values_by_id) == 0:
+      return retval
+    tagged_ids = list(values_by_id)
+
+    if value_tags:
+      # SELECT tv.tagged_id, v.name, v.value FROM tmv.valuetags AS v JOIN tmv.tagged_valuetags AS tv ON tv.tag_id = v.id WHERE tv.tagged_id = ANY({tagged_ids})
+      cur.execute_prepared('SELECT tv.tagged_id, v.name, v.value FROM ' + names['valuetags'] + ' AS v JOIN ' + names['tagged_valuetags'] + ' AS tv ON tv.tag_id = v.id WHERE tv.tagged_id = ANY(%s)', (tagged_ids,))
+      for tagged_id, name, value in cur:
+        retval[values_by_id[tagged_id]]['value'].append({'name': name, 'value': value})
+
+    if multi_tags:
+      # SELECT tv.tagged_id, v.value FROM tmv.tags AS v JOIN tmv.tagged_tags AS tv ON tv.tag_id = v.id WHERE tv.tagged_id = ANY({tagged_ids})
+      cur.execute_prepared('SELECT tv.tagged_id, v.value FROM ' + names['multitags'] + ' AS v JOIN ' + names['tagged_multitags'] + ' AS tv ON tv.tag_id = v.id WHERE tv.tagged_id = ANY(%s)', (tagged_ids,))
+      for tagged_id, value in cur:
+        retval[values_by_id[tagged_id]]['multi'].append(value)
 
     return retval
   finally:
     if cur:
       cur.close()
     if conn:
-      conn.close()
-
-def _get_implied_tags_for_multitag(multitag_id, cur, names, tags):
-  implied_tags = []
-  cur.execute('SELECT second_tag_id FROM ' + names['multitags_multitags'] + ' WHERE first_tag_id = %s', (multitag_id,))
-  response = cur.fetchone()
-  while response:
-    if not response[0] in tags:
-      implied_tags.append(response[0])
-    response = cur.fetchone()
-
-  # Only loop over tags not found previously
-  for implied_tag in implied_tags:
-    tags = _get_implied_tags_for_multitag(implied_tag, cur, names, tags + implied_tags)
-  return list(set(tags + implied_tags))
+      close_connection(conn)
 
-def tag(tagged, value_tags, multi_tags):
+# The multitags_closure table holds every (ancestor_id, descendant_id) pair where tagging something with the ancestor
+# also tags it with the descendant, directly or through other tags. It's derived from multitags_multitags, and has to be
+# kept up to date by everything that changes it.
+#
+# The updates read the closure and write rows derived from what they read, so two of them running at once would miss
+# each other's uncommitted rows (adding a -> b and b -> c concurrently never adds a -> c). Every transaction changing
+# the closure therefore takes _lock_closure first, before any other lock, which runs them one at a time.
+# Reads and the rest of the writes aren't blocked by it.
+def _lock_closure(cur, names):
+  cur.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', (names['multitags_closure'],))
+
+# Returns the given tag IDs together with every tag that implies any of them
+def _with_closure_ancestors(cur, names, tag_ids):
+  cur.execute_prepared('SELECT DISTINCT ancestor_id FROM ' + names['multitags_closure'] + ' WHERE descendant_id = ANY(%s)', (list(tag_ids),))
+  return list(set(tag_ids) | set(row[0] for row in cur.fetchall()))
+
+# Adding the edge parent -> child makes every descendant of the child (and the child itself) implied by every ancestor of the parent (and the parent itself)
+def _add_closure_edge(cur, names, parent_id, child_id):
+  cur.execute("""
+INSERT INTO """ + names['multitags_closure'] + """ (ancestor_id, descendant_id)
+SELECT a.id, d.id FROM
+  (SELECT %s::bigint AS id UNION SELECT ancestor_id FROM """ + names['multitags_closure'] + """ WHERE descendant_id = %s) AS a,
+  (SELECT %s::bigint AS id UNION SELECT descendant_id FROM """ + names['multitags_closure'] + """ WHERE ancestor_id = %s) AS d
+WHERE a.id <> d.id
+ON CONFLICT DO NOTHING""", (parent_id, parent_id, child_id, child_id))
+
+# Removing edges can't be done incrementally, since a descendant may still be reachable through another path.
+# Instead the descendants of every affected ancestor are recomputed from the multitags_multitags graph.
+def _rebuild_closure(cur, names, ancestor_ids):
+  ancestor_ids = list(ancestor_ids)
+  cur.execute('DELETE FROM ' + names['multitags_closure'] + ' WHERE ancestor_id = ANY(%s)', (ancestor_ids,))
+  cur.execute("""
+WITH RECURSIVE reachable(ancestor_id, descendant_id) AS (
+  SELECT mm.first_tag_id, mm.second_tag_id FROM """ + names['multitags_multitags'] + """ AS mm WHERE mm.first_tag_id = ANY(%s)
+  UNION
+  SELECT r.ancestor_id, mm.second_tag_id FROM reachable AS r
+    JOIN """ + names['multitags_multitags'] + """ AS mm ON mm.first_tag_id = r.descendant_id
+)
+INSERT INTO """ + names['multitags_closure'] + """ (ancestor_id, descendant_id)
+SELECT ancestor_id, descendant_id FROM reachable WHERE ancestor_id <> descendant_id
+ON CONFLICT DO NOTHING""", (ancestor_ids,))
+
+# The _get_*_ids functions return a dict mapping each of the given tags that exist to its ID, going through the tag ID cache.
+# The _select_*_ids functions do the same, but always ask the database. Untagging, deleting and renaming use those,
+# since a cached ID of a tag another tagger process renamed would make them remove rows of whatever tag has it now.
+def _select_multitag_ids(cur, names, values):
+  if len(values) == 0:
+    return {}
+
+  generation = _TAG_ID_GENERATION
+  cur.execute_prepared('SELECT value, id FROM ' + names['multitags'] + ' WHERE value = ANY(%s)', (list(values),))
+  retval = dict(cur.fetchall())
+  for value in retval:
+    _cache_tag_id(('multi', value), retval[value], generation)
+  return retval
+
+def _get_multitag_ids(cur, names, values):
+  cache = get_tag_id_cache()
+  retval = {}
+  missing = []
+  for value in set(values):
+    tag_id = cache.get(('multi', value))
+    if tag_id is None:
+      missing.append(value)
+    else:
+      retval[value] = tag_id
+
+  retval.update(_select_multitag_ids(cur, names, missing))
+  return retval
+
+# Keys are (name, value) tuples
+def _select_valuetag_ids(cur, names, tags):
+  if len(tags) == 0:
+    return {}
+
+  tags = list(tags)
+  generation = _TAG_ID_GENERATION
+  cur.execute_prepared('SELECT vt.name, vt.value, vt.id FROM ' + names['valuetags'] + ' AS vt JOIN unnest(%s::text[], %s::bigint[]) AS n(name, value) ON vt.name = n.name AND vt.value = n.value', ([t[0] for t in tags], [t[1] for t in tags]))
+  retval = {(row[0], row[1]): row[2] for row in cur.fetchall()}
+  for tag in retval:
+    _cache_tag_id(('value', tag[0], tag[1]), retval[tag], generation)
+  return retval
+
+def _get_valuetag_ids(cur, names, tags):
+  cache = get_tag_id_cache()
+  retval = {}
+  missing = []
+  for tag in set(tags):
+    tag_id = cache.get(('value', tag[0], tag[1]))
+    if tag_id is None:
+      missing.append(tag)
+    else:
+      retval[tag] = tag_id
+
+  retval.update(_select_valuetag_ids(cur, names, missing))
+  return retval
+
+# The _upsert_* functions insert whatever is missing and return a dict mapping every given key to its ID.
+# Keys are inserted in sorted order, so that concurrent batches take their row locks in the same order.
+#
+# A key skipped by ON CONFLICT DO NOTHING belongs to a row another transaction inserted, which untagging or the orphan
+# sweeper can delete again before the SELECT reads it. Its ID is then missing, and the batch is redone (see _retry_on_stale_tag_ids).
+def _check_upserted(retval, keys):
+  if len(retval) < len(keys):
+    raise _StaleTagIds()
+  return retval
+
+def _upsert_tagged(cur, names, values):
+  values = sorted(set(values))
+  cur.execute_prepared('INSERT INTO ' + names['tagged'] + ' (value) SELECT unnest(%s::text[]) ON CONFLICT DO NOTHING', (values,))
+  cur.execute_prepared('SELECT value, id FROM ' + names['tagged'] + ' WHERE value = ANY(%s)', (values,))
+  return _check_upserted(dict(cur.fetchall()), values)
+
+def _upsert_multitags(cur, names, values):
+  retval = _get_multitag_ids(cur, names, values)
+  missing = sorted(set(values) - set(retval))
+  if len(missing) > 0:
+    cur.execute_prepared('INSERT INTO ' + names['multitags'] + ' (value) SELECT unnest(%s::text[]) ON CONFLICT DO NOTHING', (missing,))
+    retval.update(_select_multitag_ids(cur, names, missing))
+  return _check_upserted(retval, set(values))
+
+# Keys are (name, value) tuples
+def _upsert_valuetags(cur, names, tags):
+  retval = _get_valuetag_ids(cur, names, tags)
+  missing = sorted(set(tags) - set(retval))
+  if len(missing) > 0:
+    cur.execute_prepared('INSERT INTO ' + names['valuetags'] + ' (name, value) SELECT * FROM unnest(%s::text[], %s::bigint[]) ON CONFLICT DO NOTHING', ([t[0] for t in missing], [t[1] for t in missing]))
+    retval.update(_select_valuetag_ids(cur, names, missing))
+  return _check_upserted(retval, set(tags))
+
+# A cached tag ID can belong to a tag another tagger process has renamed since, and now stands for a different name.
+# So bridge rows are only inserted for tags whose row still has the name the ID was looked up by, and FOR KEY SHARE keeps
+# that name from changing until the transaction ends. If any pair is left out, the batch is redone (see _retry_on_stale_tag_ids).
+#
+# Pairs map (tagged_id, tag_id) tuples to the multitag value the ID was looked up by, or None for implied multitags,
+# which come from the closure of a multitag that is checked itself.
+def _insert_multitag_bridge_rows(cur, names, pairs):
+  keys = sorted(pairs)
+  cur.execute_prepared("""
+WITH checked AS (
+  SELECT p.tagged_id, p.tag_id FROM unnest(%s::bigint[], %s::bigint[], %s::text[]) AS p(tagged_id, tag_id, value)
+    JOIN """ + names['multitags'] + """ AS mt ON mt.id = p.tag_id AND (p.value IS NULL OR mt.value = p.value)
+    FOR KEY SHARE OF mt
+), inserted AS (
+  INSERT INTO """ + names['tagged_multitags'] + """ (tagged_id, tag_id)
+    SELECT tagged_id, tag_id FROM checked ORDER BY tagged_id, tag_id ON CONFLICT DO NOTHING
+)
+SELECT COUNT(*) FROM checked""", ([k[0] for k in keys], [k[1] for k in keys], [pairs[k] for k in keys]))
+  if cur.fetchone()[0] < len(keys):
+    raise _StaleTagIds()
+
+# Pairs map (tagged_id, tag_id) tuples to the (name, value) tuple the valuetag ID was looked up by
+def _insert_valuetag_bridge_rows(cur, names, pairs):
+  keys = sorted(pairs)
+  cur.execute_prepared("""
+WITH checked AS (
+  SELECT p.tagged_id, p.tag_id FROM unnest(%s::bigint[], %s::bigint[], %s::text[], %s::bigint[]) AS p(tagged_id, tag_id, name, value)
+    JOIN """ + names['valuetags'] + """ AS vt ON vt.id = p.tag_id AND vt.name = p.name AND vt.value = p.value
+    FOR KEY SHARE OF vt
+), inserted AS (
+  INSERT INTO """ + names['tagged_valuetags'] + """ (tagged_id, tag_id)
+    SELECT tagged_id, tag_id FROM checked ORDER BY tagged_id, tag_id ON CONFLICT DO NOTHING
+)
+SELECT COUNT(*) FROM checked""", ([k[0] for k in keys], [k[1] for k in keys], [pairs[k][0] for k in keys], [pairs[k][1] for k in keys]))
+  if cur.fetchone()[0] < len(keys):
+    raise _StaleTagIds()
+
+# Expected entry format:
+#
+# [{
+#   'value': STRING,
+#   'multi_tags': STRING[],
+#   'value_tags': [{'name': STRING, 'value': INTEGER}, ...]
+# }, ...]
+#
+# Tags everything in one transaction, with a fixed amount of statements for the tags, tagged values and bridge rows
+def tag_batch(entries):
   conn = None
   cur = None
 
-  check_if_tags_are_valid(value_tags, 'Value')
-  check_if_tags_are_valid(multi_tags, 'Multi')
+  for entry in entries:
+    check_if_tags_are_valid(entry['value_tags'], 'Value')
+    check_if_tags_are_valid(entry['multi_tags'], 'Multi')
 
   try:
     conn = open_connection()
     cur = conn.cursor()
     names = get_table_names()
 
-    # Tagged
-    cur.execute('INSERT INTO ' + names['tagged'] + ' (value) VALUES (%s) ON CONFLICT DO NOTHING RETURNING id', (tagged,))
-
-    tagged_id = cur.fetchone()
-    if tagged_id is None:
-      cur.execute('SELECT id FROM ' + names['tagged'] + ' WHERE value = %s', (tagged,))
-      tagged_id = cur.fetchone()
-    tagged_id = tagged_id[0]
-
-    # Value tags
-    for tag in value_tags:
-      cur.execute('INSERT INTO ' + names['valuetags'] + ' (name, value) VALUES (%s, %s) ON CONFLICT DO NOTHING RETURNING id', (tag['name'], tag['value']))
-
-      tag_id = cur.fetchone()
-      if tag_id is None:
-        cur.execute('SELECT id FROM ' + names['valuetags'] + ' WHERE value = %s', (tag,))
-        tag_id = cur.fetchone()
-      tag_id = tag_id[0]
+    tagged_ids = _retry_on_deadlock(conn, lambda: _retry_on_stale_tag_ids(conn, lambda: _tag_batch(cur, names, entries)))
+    _commit(conn)
+    _refresh_search_engine(conn, tagged_ids)
+  finally:
+    if cur:
+      cur.close()
+    if conn:
+      close_connection(conn)
+
+def _tag_batch(cur, names, entries):
+  tagged_ids = _upsert_tagged(cur, names, [entry['value'] for entry in entries])
+  valuetag_ids = _upsert_valuetags(cur, names, [(tag['name'], tag['value']) for entry in entries for tag in entry['value_tags']])
+  multitag_ids = _upsert_multitags(cur, names, [tag for entry in entries for tag in entry['multi_tags']])
+
+  # Every multitag implies itself, plus whatever the closure says it implies
+  implied_tag_ids = {tag_id: [tag_id] for tag_id in multitag_ids.values()}
+  if len(implied_tag_ids) > 0:
+    cur.execute_prepared('SELECT ancestor_id, descendant_id FROM ' + names['multitags_closure'] + ' WHERE ancestor_id = ANY(%s)', (list(implied_tag_ids),))
+    for ancestor_id, descendant_id in cur:
+      implied_tag_ids[ancestor_id].append(descendant_id)
+
+  value_pairs = {}
+  multi_pairs = {}
+  for entry in entries:
+    tagged_id = tagged_ids[entry['value']]
+    for tag in entry['value_tags']:
+      key = (tag['name'], tag['value'])
+      value_pairs[(tagged_id, valuetag_ids[key])] = key
+    for tag in entry['multi_tags']:
+      for tag_id in implied_tag_ids[multitag_ids[tag]]:
+        multi_pairs.setdefault((tagged_id, tag_id), None)
+      multi_pairs[(tagged_id, multitag_ids[tag])] = tag
+
+  _insert_valuetag_bridge_rows(cur, names, value_pairs)
+  _insert_multitag_bridge_rows(cur, names, multi_pairs)
+  return list(tagged_ids.values())
 
-      cur.execute('INSERT INTO ' + names['tagged_valuetags'] + ' (tagged_id, tag_id) VALUES (%s, %s) ON CONFLICT DO NOTHING', (tagged_id, tag_id))
+def tag(tagged, value_tags, multi_tags):
+  tag_batch([{'value': tagged, 'value_tags': value_tags, 'multi_tags': multi_tags}])
+
+# The bridge table columns referencing each table. A row is unused once none of them reference it.
+_USES = {
+  'tagged': [('tagged_multitags', 'tagged_id'), ('tagged_valuetags', 'tagged_id')],
+  'multitags': [('tagged_multitags', 'tag_id'), ('multitags_multitags', 'first_tag_id'), ('multitags_multitags', 'second_tag_id')],
+  'valuetags': [('tagged_valuetags', 'tag_id')]
+}
+
+# Condition on the row <alias> of <table> being unused. Every bridge column has an index (see create_tables and migrations.py),
+# so each probe stops at the first reference it finds, and costs the same no matter how popular a tag is.
+def _unused(names, table, alias):
+  return ' AND '.join('NOT EXISTS (SELECT 1 FROM ' + names[bridge] + ' AS u WHERE u.' + column + ' = ' + alias + '.id)' for bridge, column in _USES[table])
+
+# Deleting a row takes FOR UPDATE on it, which conflicts with the FOR KEY SHARE a concurrent insert of a bridge row takes
+# on the tag and tagged value it references. So the rows that may be deleted are locked FOR UPDATE by _lock_removal_candidates
+# before any bridge row is deleted, in order of ID. A concurrent insert then either waits for the whole untag, and finds
+# the tag missing if it was deleted and redoes its work (see _retry_on_stale_tag_ids), or it got its lock first, in which
+# case the untag waits for it to commit, and the probe of the delete sees its bridge rows.
+#
+# Deleting tags and merging them into others lock the tags they delete the same way, see _lock_rows.
+#
+# With the orphan sweeper enabled these do nothing, and sweep_orphans() removes the unused rows later instead.
+def _lock_removal_candidates(cur, names, table, ids):
+  if _orphans_deferred():
+    return
+  _lock_rows(cur, names, table, ids)
+
+# Locks the rows of <table> with the given IDs FOR UPDATE, in order of ID
+def _lock_rows(cur, names, table, ids):
+  if len(ids) == 0:
+    return
+  cur.execute_prepared('SELECT id FROM ' + names[table] + ' WHERE id = ANY(%s) ORDER BY id FOR UPDATE', (sorted(set(ids)),))
 
-    # Multi tags
-    for tag in multi_tags:
-      cur.execute('INSERT INTO ' + names['multitags'] + ' (value) VALUES (%s) ON CONFLICT DO NOTHING RETURNING id', (tag,))
+def _remove_tagged_if_no_tags(tagged_id, cur, names):
+  if _orphans_deferred():
+    return
+  cur.execute_prepared('DELETE FROM ' + names['tagged'] + ' AS o WHERE o.id = %s AND ' + _unused(names, 'tagged', 'o'), (tagged_id,))
+
+def _remove_multitags_if_unused(multitag_ids, cur, names):
+  if _orphans_deferred() or len(multitag_ids) == 0:
+    return
+  cur.execute_prepared('DELETE FROM ' + names['multitags'] + ' AS o WHERE o.id = ANY(%s) AND ' + _unused(names, 'multitags', 'o') + ' RETURNING o.value', (sorted(set(multitag_ids)),))
+  for row in cur.fetchall():
+    _invalidate_tag_id(('multi', row[0]))
+
+def _remove_valuetags_if_unused(valuetag_ids, cur, names):
+  if _orphans_deferred() or len(valuetag_ids) == 0:
+    return
+  cur.execute_prepared('DELETE FROM ' + names['valuetags'] + ' AS o WHERE o.id = ANY(%s) AND ' + _unused(names, 'valuetags', 'o') + ' RETURNING o.name, o.value', (sorted(set(valuetag_ids)),))
+  for row in cur.fetchall():
+    _invalidate_tag_id(('value', row[0], row[1]))
+
+# Orphan sweeper. Enabled by setting TMV_TAGGER_ORPHAN_SWEEP_INTERVAL above 0, in which case untagging only removes
+# bridge rows, and the tagger runs sweep_orphans() every that many seconds to delete whatever was left unused.
+_ORPHAN_TABLES = [
+  # stats key, table, returned columns, cache key
+  ('value_tags', 'valuetags', 'o.name, o.value', lambda row: ('value', row[0], row[1])),
+  ('multi_tags', 'multitags', 'o.value', lambda row: ('multi', row[0])),
+  ('tagged', 'tagged', 'o.id', None)
+]
+
+_ORPHAN_SWEEPER_STATS = {
+  'runs': 0,
+  'deleted': {key: 0 for key, table, returning, cache_key in _ORPHAN_TABLES},
+  'backlog': {key: None for key, table, returning, cache_key in _ORPHAN_TABLES},
+  'last_run_seconds': None,
+  'last_run_at': None
+}
+_ORPHAN_SWEEPER_LOCK = threading.Lock()
+
+def _orphans_deferred():
+  return float(dotenv.read()['TMV_TAGGER_ORPHAN_SWEEP_INTERVAL']) > 0
+
+def get_orphan_sweeper_stats():
+  with _ORPHAN_SWEEPER_LOCK:
+    return {
+      'runs': _ORPHAN_SWEEPER_STATS['runs'],
+      'deleted': dict(_ORPHAN_SWEEPER_STATS['deleted']),
+      'backlog': dict(_ORPHAN_SWEEPER_STATS['backlog']),
+      'last_run_seconds': _ORPHAN_SWEEPER_STATS['last_run_seconds'],
+      'last_run_at': _ORPHAN_SWEEPER_STATS['last_run_at']
+    }
+
+def _orphan_backlog():
+  with _ORPHAN_SWEEPER_LOCK:
+    return {(key,): count for key, count in _ORPHAN_SWEEPER_STATS['backlog'].items() if count is not None}
+
+metrics.register(metrics.Gauge('tmv_orphans_backlog', 'Unused rows left for the orphan sweeper, as of its last run', _orphan_backlog, ('table',)))
+
+# Deletes unused rows in batches of batch_size, one transaction per batch, until there are none left.
+# Deleting an unused row never makes another one unused, so every table is swept on its own, walking it once in order of ID.
+# Rows locked by other transactions (e.g. one about to tag something with the tag) are skipped, and picked up by the next
+# run if still unused. The rows found are locked first and deleted by a second statement, which checks them again:
+# a tag batch may have used one between the snapshot of the first statement and it taking the lock.
+def sweep_orphans(batch_size):
+  conn = None
+  cur = None
+  start = time.perf_counter()
 
-      tag_id = cur.fetchone()
-      if tag_id is None:
-        cur.execute('SELECT id FROM ' + names['multitags'] + ' WHERE value = %s', (tag,))
-        tag_id = cur.fetchone()
-      tag_id = tag_id[0]
+  try:
+    conn = open_connection()
+    cur = conn.cursor()
+    names = get_table_names()
+    deleted_tagged_ids = []
+
+    for key, table, returning, cache_key in _ORPHAN_TABLES:
+      after_id = 0
+      found = batch_size
+      while found == batch_size:
+        cur.execute_prepared('SELECT o.id FROM ' + names[table] + ' AS o WHERE o.id > %s AND ' + _unused(names, table, 'o') + ' ORDER BY o.id LIMIT %s FOR UPDATE SKIP LOCKED', (after_id, batch_size))
+        ids = [row[0] for row in cur.fetchall()]
+        found = len(ids)
+        rows = []
+        if found > 0:
+          after_id = ids[-1]
+          cur.execute_prepared('DELETE FROM ' + names[table] + ' AS o WHERE o.id = ANY(%s) AND ' + _unused(names, table, 'o') + ' RETURNING ' + returning, (ids,))
+          rows = cur.fetchall()
+        # Orphans don't match any search, so there's no need to invalidate the search cache
+        conn.commit()
+
+        deleted = len(rows)
+        for row in rows:
+          if cache_key is not None:
+            _invalidate_tag_id(cache_key(row))
+          else:
+            deleted_tagged_ids.append(row[0])
+        with _ORPHAN_SWEEPER_LOCK:
+          _ORPHAN_SWEEPER_STATS['deleted'][key] += deleted
+        metrics.ORPHANS_DELETED.inc((key,), deleted)
+
+    backlog = {}
+    for key, table, returning, cache_key in _ORPHAN_TABLES:
+      cur.execute_prepared('SELECT COUNT(*) FROM ' + names[table] + ' AS o WHERE ' + _unused(names, table, 'o'))
+      backlog[key] = cur.fetchone()[0]
+    conn.commit()
 
-      tag_ids = _get_implied_tags_for_multitag(tag_id, cur, names, [tag_id])
-      for tag_id in tag_ids:
-        cur.execute('INSERT INTO ' + names['tagged_multitags'] + ' (tagged_id, tag_id) VALUES (%s, %s) ON CONFLICT DO NOTHING', (tagged_id, tag_id))
+    _refresh_search_engine(conn, deleted_tagged_ids)
 
-    conn.commit()
+    with _ORPHAN_SWEEPER_LOCK:
+      _ORPHAN_SWEEPER_STATS['runs'] += 1
+      _ORPHAN_SWEEPER_STATS['backlog'] = backlog
+      _ORPHAN_SWEEPER_STATS['last_run_seconds'] = time.perf_counter() - start
+      _ORPHAN_SWEEPER_STATS['last_run_at'] = time.time()
   finally:
     if cur:
       cur.close()
     if conn:
-      conn.close()
-
-def _remove_tagged_if_no_tags(tagged_id, cur, names):
-  cur.execute('SELECT COUNT(*) FROM ' + names['tagged_valuetags'] + ' WHERE tagged_id = %s', (tagged_id,))
-  value_count = cur.fetchone()[0]
-  cur.execute('SELECT COUNT(*) FROM ' + names['tagged_multitags'] + ' WHERE tagged_id = %s', (tagged_id,))
-  multi_count = cur.fetchone()[0]
-  if value_count == 0 and multi_count == 0:
-    cur.execute('DELETE FROM ' + names['tagged'] + ' WHERE id = %s', (tagged_id,))
-
-def _remove_multitag_if_unused(multitag_id, cur, names):
-  cur.execute('SELECT COUNT(*) FROM ' + names['tagged_multitags'] + ' WHERE tag_id = %s', (multitag_id,))
-  tagged_count = cur.fetchone()[0]
-  cur.execute('SELECT COUNT(*) FROM ' + names['multitags_multitags'] + ' WHERE first_tag_id = %s OR second_tag_id = %s', (multitag_id, multitag_id))
-  multi_multi_count = cur.fetchone()[0]
-  if tagged_count == 0 and multi_multi_count == 0:
-    cur.execute('DELETE FROM ' + names['multitags'] + ' WHERE id = %s', (multitag_id,))
-
-def _remove_valuetag_if_unused(valuetag_id, cur, names):
-  cur.execute('SELECT COUNT(*) FROM ' + names['tagged_valuetags'] + ' WHERE tag_id = %s', (valuetag_id,))
-  tagged_count = cur.fetchone()[0]
-  if tagged_count == 0:
-    cur.execute('DELETE FROM ' + names['valuetags'] + ' WHERE id = %s', (valuetag_id,))
+      close_connection(conn)
 
 def untag(tagged, value_tags, multi_tags):
   conn = None
@@ -411,40 +1201,43 @@ def untag(tagged, value_tags, multi_tags):
     cur = conn.cursor()
     names = get_table_names()
 
-    cur.execute('SELECT id FROM ' + names['tagged'] + ' WHERE value = %s', (tagged,))
-    tagged_id = cur.fetchone()
-    if tagged_id is None:
-      raise TMVException(TMVException.ID_TAGGED_NOT_FOUND, 'The given value \'{}\' could not be found in the database'.format(tagged))
-    tagged_id = tagged_id[0]
-
-    # Value tags
-    for tag in value_tags:
-      cur.execute('SELECT id FROM ' + names['valuetags'] + ' WHERE name = %s AND value = %s', (tag['name'], tag['value']))
-      tag_id = cur.fetchone()
-      if tag_id is None:
-        continue # Tag could not be found
-      tag_id = tag_id[0]
-      cur.execute('DELETE FROM ' + names['tagged_valuetags'] + ' WHERE tagged_id = %s AND tag_id = %s', (tagged_id, tag_id))
-      _remove_valuetag_if_unused(tag_id, cur, names)
-
-    # Multi tags
-    for tag in multi_tags:
-      cur.execute('SELECT id FROM ' + names['multitags'] + ' WHERE value = %s', (tag,))
-      tag_id = cur.fetchone()
-      if tag_id is None:
-        continue # Tag could not be found
-      tag_id = tag_id[0]
-      cur.execute('DELETE FROM ' + names['tagged_multitags'] + ' WHERE tagged_id = %s AND tag_id = %s', (tagged_id, tag_id))
-      _remove_multitag_if_unused(tag_id, cur, names)
-
-    # Tagged
-    _remove_tagged_if_no_tags(tagged_id, cur, names)
-    conn.commit()
+    tagged_id = _retry_on_deadlock(conn, lambda: _untag(cur, names, tagged, value_tags, multi_tags))
+    _commit(conn)
+    _refresh_search_engine(conn, [tagged_id])
   finally:
     if cur:
       cur.close()
     if conn:
-      conn.close()
+      close_connection(conn)
+
+# Locks the tagged value FOR UPDATE too when it may be deleted, see _lock_removal_candidates
+def _select_tagged_id_for_untag(cur, names, tagged):
+  cur.execute_prepared('SELECT id FROM ' + names['tagged'] + ' WHERE value = %s' + ('' if _orphans_deferred() else ' FOR UPDATE'), (tagged,))
+  tagged_id = cur.fetchone()
+  if tagged_id is None:
+    raise TMVException(TMVException.ID_TAGGED_NOT_FOUND, 'The given value \'{}\' could not be found in the database'.format(tagged))
+  return tagged_id[0]
+
+def _untag(cur, names, tagged, value_tags, multi_tags):
+  tagged_id = _select_tagged_id_for_untag(cur, names, tagged)
+  valuetag_ids = _select_valuetag_ids(cur, names, set((tag['name'], tag['value']) for tag in value_tags))
+  multitag_ids = _select_multitag_ids(cur, names, set(multi_tags))
+  _lock_removal_candidates(cur, names, 'valuetags', list(valuetag_ids.values()))
+  _lock_removal_candidates(cur, names, 'multitags', list(multitag_ids.values()))
+
+  # Value tags
+  for tag_id in valuetag_ids.values():
+    cur.execute_prepared('DELETE FROM ' + names['tagged_valuetags'] + ' WHERE tagged_id = %s AND tag_id = %s', (tagged_id, tag_id))
+  _remove_valuetags_if_unused(list(valuetag_ids.values()), cur, names)
+
+  # Multi tags
+  for tag_id in multitag_ids.values():
+    cur.execute_prepared('DELETE FROM ' + names['tagged_multitags'] + ' WHERE tagged_id = %s AND tag_id = %s', (tagged_id, tag_id))
+  _remove_multitags_if_unused(list(multitag_ids.values()), cur, names)
+
+  # Tagged
+  _remove_tagged_if_no_tags(tagged_id, cur, names)
+  return tagged_id
 
 def untag_all(tagged):
   conn = None
@@ -455,42 +1248,54 @@ def untag_all(tagged):
     cur = conn.cursor()
     names = get_table_names()
 
-    cur.execute('SELECT id FROM ' + names['tagged'] + ' WHERE value = %s', (tagged,))
-    tagged_id = cur.fetchone()
-    if tagged_id is None:
-      raise TMVException(TMVException.ID_TAGGED_NOT_FOUND, 'The given value \'{}\' could not be found in the database'.format(tagged))
-    tagged_id = tagged_id[0]
-
-    # Value tags
-    cur.execute('DELETE FROM ' + names['tagged_valuetags'] + ' WHERE tagged_id = %s RETURNING tag_id', (tagged_id,))
-    value_tags = []
+    tagged_id = _retry_on_deadlock(conn, lambda: _untag_all(cur, names, tagged))
+    _commit(conn)
+    _refresh_search_engine(conn, [tagged_id])
+  finally:
+    if cur:
+      cur.close()
+    if conn:
+      close_connection(conn)
+
+def _untag_all(cur, names, tagged):
+  tagged_id = _select_tagged_id_for_untag(cur, names, tagged)
+
+  # With the tagged value locked, no bridge rows can be added to it until this commits
+  if not _orphans_deferred():
+    cur.execute_prepared('SELECT tag_id FROM ' + names['tagged_valuetags'] + ' WHERE tagged_id = %s', (tagged_id,))
+    _lock_removal_candidates(cur, names, 'valuetags', [row[0] for row in cur.fetchall()])
+    cur.execute_prepared('SELECT tag_id FROM ' + names['tagged_multitags'] + ' WHERE tagged_id = %s', (tagged_id,))
+    _lock_removal_candidates(cur, names, 'multitags', [row[0] for row in cur.fetchall()])
+
+  # Value tags
+  cur.execute_prepared('DELETE FROM ' + names['tagged_valuetags'] + ' WHERE tagged_id = %s RETURNING tag_id', (tagged_id,))
+  value_tags = []
+  tag_id = cur.fetchone()
+  while tag_id:
+    value_tags.append(tag_id[0])
     tag_id = cur.fetchone()
-    while tag_id:
-      value_tags.append(tag_id[0])
-      tag_id = cur.fetchone()
 
-    for value_tag in value_tags:
-      _remove_valuetag_if_unused(value_tag, cur, names)
+  _remove_valuetags_if_unused(value_tags, cur, names)
 
-    # Multitags
-    cur.execute('DELETE FROM ' + names['tagged_multitags'] + ' WHERE tagged_id = %s RETURNING tag_id', (tagged_id,))
-    multi_tags = []
+  # Multitags
+  cur.execute_prepared('DELETE FROM ' + names['tagged_multitags'] + ' WHERE tagged_id = %s RETURNING tag_id', (tagged_id,))
+  multi_tags = []
+  tag_id = cur.fetchone()
+  while tag_id:
+    multi_tags.append(tag_id[0])
     tag_id = cur.fetchone()
-    while tag_id:
-      multi_tags.append(tag_id[0])
-      tag_id = cur.fetchone()
 
-    for multi_tag in multi_tags:
-      _remove_multitag_if_unused(multi_tag, cur, names)
+  _remove_multitags_if_unused(multi_tags, cur, names)
+  return tagged_id
 
-    conn.commit()
-  finally:
-    if cur:
-      cur.close()
-    if conn:
-      conn.close()
+# Renames run as a fixed amount of statements, no matter how many are given. Renaming a tag to one that already exists
+# fails, unless merge is set: then the old tag's bridge rows are moved to the existing tag, duplicates dropped, and
+# the old tag deleted. Tagged values are never merged.
+def rename(tagged, multitags, valuetags, merge=False):
+  _check_renames('values', [t['old'] for t in tagged], [t['new'] for t in tagged])
+  _check_renames('multi_tags', [t['old'] for t in multitags], [t['new'] for t in multitags])
+  _check_renames('value_tags', [(t['old']['name'], t['old']['value']) for t in valuetags], [(t['new']['name'], t['new']['value']) for t in valuetags])
 
-def rename(tagged, multitags, valuetags):
   conn = None
   cur = None
 
@@ -499,21 +1304,132 @@ def rename(tagged, multitags, valuetags):
     cur = conn.cursor()
     names = get_table_names()
 
-    for t in tagged:
-      cur.execute('UPDATE ' + names['tagged'] + ' SET value = %s WHERE value = %s', (t['new'], t['old']))
-
-    for t in multitags:
-      cur.execute('UPDATE ' + names['multitags'] + ' SET value = %s WHERE value = %s', (t['new'], t['old']))
+    refresh_ids = _search_engine_ids_with_multitags([t['old'] for t in multitags])
+    refresh_ids += _search_engine_ids_with_valuetags([(t['old']['name'], t['old']['value']) for t in valuetags])
 
-    for t in valuetags:
-      cur.execute('UPDATE ' + names['valuetags'] + ' SET name = %s, value = %s WHERE name = %s AND value = %s', (t['new']['name'], t['new']['value'], t['old']['name'], t['old']['value']))
+    try:
+      refresh_ids += _retry_on_deadlock(conn, lambda: _rename(cur, names, tagged, multitags, valuetags, merge))
+    except psycopg2.errors.UniqueViolation:
+      conn.rollback()
+      raise TMVException(TMVException.ID_FAULTY_INPUT, 'A new name is already taken' + ('' if merge else ', set \'merge\' to merge tags into existing ones'))
 
-    conn.commit()
+    _commit(conn)
+    _refresh_search_engine(conn, refresh_ids)
   finally:
     if cur:
       cur.close()
     if conn:
-      conn.close()
+      close_connection(conn)
+
+# Returns the IDs of the renamed tagged values
+def _rename(cur, names, tagged, multitags, valuetags, merge):
+  # Merging multitags moves implications
+  if merge and len(multitags) > 0:
+    _lock_closure(cur, names)
+
+  tagged_ids = _rename_tagged(cur, names, tagged)
+  _rename_multitags(cur, names, multitags, merge)
+  _rename_valuetags(cur, names, valuetags, merge)
+  return tagged_ids
+
+# Chains and swaps (a -> b, b -> c) would depend on the order rows are updated in
+def _check_renames(param, olds, news):
+  if len(set(olds)) != len(olds):
+    raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'{}\' renames the same name more than once'.format(param))
+  if not set(olds).isdisjoint(news):
+    raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'{}\' cannot rename to a name it also renames'.format(param))
+
+def _rename_tagged(cur, names, tagged):
+  if len(tagged) == 0:
+    return []
+  cur.execute('UPDATE ' + names['tagged'] + ' AS t SET value = r.new FROM unnest(%s::text[], %s::text[]) AS r(old, new) WHERE t.value = r.old RETURNING t.id', ([t['old'] for t in tagged], [t['new'] for t in tagged]))
+  return [row[0] for row in cur.fetchall()]
+
+# Returns ([(old_id, new_value)], [(old_id, new_id)]), the tags to rename and the tags to merge into existing ones
+def _split_renames(old_ids, new_ids, renames, merge):
+  updates = []
+  merges = []
+  for old, new in renames:
+    if old not in old_ids:
+      continue
+    if new in new_ids:
+      if not merge:
+        raise TMVException(TMVException.ID_FAULTY_INPUT, 'Tag \'{}\' already exists, set \'merge\' to merge into it'.format(new if isinstance(new, str) else new[0] + str(new[1])))
+      if old_ids[old] != new_ids[new]:
+        merges.append((old_ids[old], new_ids[new]))
+    else:
+      updates.append((old_ids[old], new))
+  return sorted(updates), sorted(merges)
+
+def _rename_multitags(cur, names, multitags, merge):
+  renames = [(t['old'], t['new']) for t in multitags]
+  if len(renames) == 0:
+    return
+
+  old_ids = _select_multitag_ids(cur, names, set(r[0] for r in renames))
+  new_ids = _select_multitag_ids(cur, names, set(r[1] for r in renames))
+  updates, merges = _split_renames(old_ids, new_ids, renames, merge)
+
+  if len(updates) > 0:
+    cur.execute('UPDATE ' + names['multitags'] + ' AS m SET value = r.new FROM unnest(%s::bigint[], %s::text[]) AS r(id, new) WHERE m.id = r.id', ([u[0] for u in updates], [u[1] for u in updates]))
+
+  if len(merges) > 0:
+    merged_ids = [m[0] for m in merges]
+    pairs = ([m[0] for m in merges], [m[1] for m in merges])
+    closure_ancestor_ids = set(_with_closure_ancestors(cur, names, merged_ids + pairs[1])) - set(merged_ids)
+
+    _lock_rows(cur, names, 'multitags', merged_ids)
+    _merge_bridge_rows(cur, names['tagged_multitags'], pairs)
+
+    # Implications are moved on both ends, dropping the ones that would make a tag imply itself
+    cur.execute("""
+INSERT INTO """ + names['multitags_multitags'] + """ (first_tag_id, second_tag_id)
+SELECT first_tag_id, second_tag_id FROM (
+  SELECT COALESCE(f.new_id, mm.first_tag_id) AS first_tag_id, COALESCE(s.new_id, mm.second_tag_id) AS second_tag_id
+  FROM """ + names['multitags_multitags'] + """ AS mm
+    LEFT JOIN unnest(%s::bigint[], %s::bigint[]) AS f(old_id, new_id) ON mm.first_tag_id = f.old_id
+    LEFT JOIN unnest(%s::bigint[], %s::bigint[]) AS s(old_id, new_id) ON mm.second_tag_id = s.old_id
+  WHERE f.old_id IS NOT NULL OR s.old_id IS NOT NULL
+) AS moved
+WHERE first_tag_id <> second_tag_id
+ON CONFLICT DO NOTHING""", pairs + pairs)
+    cur.execute('DELETE FROM ' + names['multitags_multitags'] + ' WHERE first_tag_id = ANY(%s) OR second_tag_id = ANY(%s)', (merged_ids, merged_ids))
+
+    # Closure rows of the merged tags go with them through ON DELETE CASCADE
+    cur.execute('DELETE FROM ' + names['multitags'] + ' WHERE id = ANY(%s)', (merged_ids,))
+    _rebuild_closure(cur, names, closure_ancestor_ids)
+
+  for old, new in renames:
+    _invalidate_tag_id(('multi', old))
+    _invalidate_tag_id(('multi', new))
+
+def _rename_valuetags(cur, names, valuetags, merge):
+  renames = [((t['old']['name'], t['old']['value']), (t['new']['name'], t['new']['value'])) for t in valuetags]
+  if len(renames) == 0:
+    return
+
+  old_ids = _select_valuetag_ids(cur, names, set(r[0] for r in renames))
+  new_ids = _select_valuetag_ids(cur, names, set(r[1] for r in renames))
+  updates, merges = _split_renames(old_ids, new_ids, renames, merge)
+
+  if len(updates) > 0:
+    cur.execute('UPDATE ' + names['valuetags'] + ' AS v SET name = r.name, value = r.value FROM unnest(%s::bigint[], %s::text[], %s::bigint[]) AS r(id, name, value) WHERE v.id = r.id', ([u[0] for u in updates], [u[1][0] for u in updates], [u[1][1] for u in updates]))
+
+  if len(merges) > 0:
+    merged_ids = [m[0] for m in merges]
+    _lock_rows(cur, names, 'valuetags', merged_ids)
+    _merge_bridge_rows(cur, names['tagged_valuetags'], ([m[0] for m in merges], [m[1] for m in merges]))
+    cur.execute('DELETE FROM ' + names['valuetags'] + ' WHERE id = ANY(%s)', (merged_ids,))
+
+  for old, new in renames:
+    _invalidate_tag_id(('value', old[0], old[1]))
+    _invalidate_tag_id(('value', new[0], new[1]))
+
+# pairs is ([old_id], [new_id]). Tagged values having both tags keep a single bridge row.
+# The old tags have to be locked already, so that no bridge rows are added to them while they're moved (see _lock_rows).
+def _merge_bridge_rows(cur, table, pairs):
+  cur.execute('INSERT INTO ' + table + ' (tagged_id, tag_id) SELECT b.tagged_id, r.new_id FROM ' + table + ' AS b JOIN unnest(%s::bigint[], %s::bigint[]) AS r(old_id, new_id) ON b.tag_id = r.old_id ON CONFLICT DO NOTHING', pairs)
+  cur.execute('DELETE FROM ' + table + ' WHERE tag_id = ANY(%s)', (pairs[0],))
 
 def tag_tags(multitags):
   conn = None
@@ -524,32 +1440,59 @@ def tag_tags(multitags):
     cur = conn.cursor()
     names = get_table_names()
 
-    for parent_tag in multitags:
-      cur.execute('SELECT id FROM ' + names['multitags'] + ' WHERE value = %s', (parent_tag,))
-      parent_id = cur.fetchone()
-      if not parent_id:
-        continue # Tag couldn't be found
-      parent_id = parent_id[0]
-
-      for child_tag in multitags[parent_tag]:
-        cur.execute('SELECT id FROM ' + names['multitags'] + ' WHERE value = %s', (child_tag,))
-        child_id = cur.fetchone()
-        if not child_id:
-          cur.execute('INSERT INTO ' + names['multitags'] + ' (value) VALUES (%s) ON CONFLICT DO NOTHING RETURNING id', (child_tag,))
-          child_id = cur.fetchone()
-        child_id = child_id[0]
-        if parent_id == child_id:
-          continue # Can't tag self with self
-        cur.execute('INSERT INTO ' + names['multitags_multitags'] + ' (first_tag_id, second_tag_id) VALUES (%s, %s) ON CONFLICT DO NOTHING', (parent_id, child_id))
-
-    conn.commit()
+    _retry_on_stale_tag_ids(conn, lambda: _tag_tags(cur, names, multitags))
+    _commit(conn)
   finally:
     if cur:
       cur.close()
     if conn:
-      conn.close()
-
-def get_tags(multi, value):
+      close_connection(conn)
+
+def _tag_tags(cur, names, multitags):
+  _lock_closure(cur, names)
+
+  # Parents have to exist already, children are created if needed
+  parent_ids = _get_multitag_ids(cur, names, multitags)
+  child_ids = _upsert_multitags(cur, names, [child_tag for parent_tag in parent_ids for child_tag in multitags[parent_tag]])
+
+  for parent_tag in parent_ids:
+    parent_id = parent_ids[parent_tag]
+    for child_tag in multitags[parent_tag]:
+      child_id = child_ids[child_tag]
+      if parent_id == child_id:
+        continue # Can't tag self with self
+      cur.execute('INSERT INTO ' + names['multitags_multitags'] + ' (first_tag_id, second_tag_id) VALUES (%s, %s) ON CONFLICT DO NOTHING', (parent_id, child_id))
+      if cur.rowcount > 0:
+        _add_closure_edge(cur, names, parent_id, child_id)
+
+def _escape_like(value):
+  return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+# kind is 'multi' or 'value'. A prefix matches multitags by value and valuetags by '<name><value>',
+# so both can use their text_pattern_ops indexes. The limit applies to each kind separately.
+def _get_tags_statement(kind, prefix, limit, names):
+  if kind == 'multi':
+    sql = 'SELECT value FROM ' + names['multitags']
+    column = 'value'
+  else:
+    sql = 'SELECT vt.name, vt.value FROM ' + names['valuetags'] + ' AS vt'
+    column = _fullname('vt')
+
+  params = []
+  if prefix is not None:
+    sql += ' WHERE ' + column + ' LIKE %s'
+    params.append(_escape_like(prefix) + '%')
+  if limit is not None:
+    sql += ' LIMIT %s'
+    params.append(limit)
+  return sql, params
+
+def _get_tags_row(kind, row):
+  if kind == 'multi':
+    return row[0]
+  return {'name': row[0], 'value': row[1]}
+
+def get_tags(multi, value, prefix=None, limit=None):
   conn = None
   cur = None
 
@@ -559,28 +1502,38 @@ def get_tags(multi, value):
     names = get_table_names()
     retval = {}
 
-    if multi:
-      retval['multi_tags'] = []
-      cur.execute('SELECT value FROM ' + names['multitags'])
-      response = cur.fetchone()
-      while response:
-        retval['multi_tags'].append(response[0])
-        response = cur.fetchone()
-
-    if value:
-      retval['value_tags'] = []
-      cur.execute('SELECT name, value FROM ' + names['valuetags'])
-      response = cur.fetchone()
-      while response:
-        retval['value_tags'].append({'name': response[0], 'value': response[1]})
-        response = cur.fetchone()
+    for kind, wanted, key in [('multi', multi, 'multi_tags'), ('value', value, 'value_tags')]:
+      if wanted:
+        cur.execute(*_get_tags_statement(kind, prefix, limit, names))
+        retval[key] = [_get_tags_row(kind, row) for row in cur.fetchall()]
 
     return retval
   finally:
     if cur:
       cur.close()
     if conn:
-      conn.close()
+      close_connection(conn)
+
+# Same as get_tags for a single kind, but reads the tags through a server side cursor and yields them in lists of batch_size
+def get_tags_stream(kind, prefix, limit, batch_size):
+  conn = None
+  cur = None
+
+  try:
+    conn = open_connection()
+    cur = conn.cursor(name='tmv_get_tags_stream')
+    cur.itersize = batch_size
+    cur.execute(*_get_tags_statement(kind, prefix, limit, get_table_names()))
+
+    rows = cur.fetchmany(batch_size)
+    while rows:
+      yield [_get_tags_row(kind, row) for row in rows]
+      rows = cur.fetchmany(batch_size)
+  finally:
+    if cur:
+      cur.close()
+    if conn:
+      close_connection(conn)
 
 def get_implied_tags(multitags):
   conn = None
@@ -592,13 +1545,12 @@ def get_implied_tags(multitags):
     names = get_table_names()
 
     retval = {'multi_tags': {}}
+    multitag_ids = _get_multitag_ids(cur, names, multitags)
     for multitag in multitags:
       retval['multi_tags'][multitag] = []
-      cur.execute('SELECT id FROM ' + names['multitags'] + ' WHERE value = %s', (multitag,))
-      multi_id = cur.fetchone()
-      if not multi_id:
+      if multitag not in multitag_ids:
         continue
-      multi_id = multi_id[0]
+      multi_id = multitag_ids[multitag]
 
       cur.execute('SELECT value FROM ' + names['multitags'] + ' WHERE id IN (SELECT second_tag_id FROM ' + names['multitags_multitags'] + ' WHERE first_tag_id = %s)', (multi_id,))
       result = cur.fetchone()
@@ -610,7 +1562,7 @@ def get_implied_tags(multitags):
     if cur:
       cur.close()
     if conn:
-      conn.close()
+      close_connection(conn)
 
 def untag_tags(multitags):
   conn = None
@@ -621,40 +1573,42 @@ def untag_tags(multitags):
     cur = conn.cursor()
     names = get_table_names()
 
-    for parent_tag in multitags:
-      cur.execute('SELECT id FROM ' + names['multitags'] + ' WHERE value = %s', (parent_tag,))
-      parent_id = cur.fetchone()
-      if not parent_id:
-        continue
-      parent_id = parent_id[0]
-
-      if multitags[parent_tag] == 'all':
-        cur.execute('SELECT second_tag_id FROM ' + names['multitags_multitags'] + ' WHERE first_tag_id = %s', (parent_id,))
-        child_ids = []
-        response = cur.fetchone()
-        while response:
-          child_ids.append(response[0])
-          response = cur.fetchone()
-        cur.execute('DELETE FROM ' + names['multitags_multitags'] + ' WHERE first_tag_id = %s', (parent_id,))
-        for child_id in child_ids:
-          _remove_multitag_if_unused(child_id, cur, names)
-      else:
-        for child_tag in multitags[parent_tag]:
-          cur.execute('SELECT id FROM ' + names['multitags'] + ' WHERE value = %s', (child_tag,))
-          child_id = cur.fetchone()
-          if not child_id:
-            continue
-          child_id = child_id[0]
-          cur.execute('DELETE FROM ' + names['multitags_multitags'] + ' WHERE first_tag_id = %s AND second_tag_id = %s', (parent_id, child_id))
-          _remove_multitag_if_unused(child_id, cur, names)
-
-      _remove_multitag_if_unused(parent_id, cur, names)
-    conn.commit()
+    _retry_on_deadlock(conn, lambda: _untag_tags(cur, names, multitags))
+    _commit(conn)
   finally:
     if cur:
       cur.close()
     if conn:
-      conn.close()
+      close_connection(conn)
+
+# Runs a fixed amount of statements, no matter how many tags are given
+def _untag_tags(cur, names, multitags):
+  _lock_closure(cur, names)
+
+  parent_ids = _select_multitag_ids(cur, names, set(multitags))
+  if len(parent_ids) == 0:
+    return
+
+  all_parent_ids = sorted(parent_ids[tag] for tag in parent_ids if multitags[tag] == 'all')
+  some_parents = [tag for tag in parent_ids if multitags[tag] != 'all']
+  child_ids = _select_multitag_ids(cur, names, set(child_tag for parent_tag in some_parents for child_tag in multitags[parent_tag]))
+  pairs = sorted(set((parent_ids[parent_tag], child_ids[child_tag]) for parent_tag in some_parents for child_tag in multitags[parent_tag] if child_tag in child_ids))
+  closure_ancestor_ids = _with_closure_ancestors(cur, names, list(parent_ids.values()))
+
+  # Implications only change under the closure lock, so the children read here are the ones deleted below
+  removed_ids = set(parent_ids.values()) | set(child_ids.values())
+  if len(all_parent_ids) > 0:
+    cur.execute('SELECT second_tag_id FROM ' + names['multitags_multitags'] + ' WHERE first_tag_id = ANY(%s)', (all_parent_ids,))
+    removed_ids.update(row[0] for row in cur.fetchall())
+  _lock_removal_candidates(cur, names, 'multitags', list(removed_ids))
+
+  if len(all_parent_ids) > 0:
+    cur.execute('DELETE FROM ' + names['multitags_multitags'] + ' WHERE first_tag_id = ANY(%s)', (all_parent_ids,))
+  if len(pairs) > 0:
+    cur.execute('DELETE FROM ' + names['multitags_multitags'] + ' AS mm USING unnest(%s::bigint[], %s::bigint[]) AS p(first_tag_id, second_tag_id) WHERE mm.first_tag_id = p.first_tag_id AND mm.second_tag_id = p.second_tag_id', ([p[0] for p in pairs], [p[1] for p in pairs]))
+
+  _remove_multitags_if_unused(list(removed_ids), cur, names)
+  _rebuild_closure(cur, names, closure_ancestor_ids)
 
 def delete_tags(multi, value):
   conn = None
@@ -665,30 +1619,42 @@ def delete_tags(multi, value):
     cur = conn.cursor()
     names = get_table_names()
 
-    # Multitags
-    for tag in multi:
-      cur.execute('SELECT id FROM ' + names['multitags'] + ' WHERE value = %s', (tag,))
-      multi_id = cur.fetchone()
-      if not multi_id:
-        continue
-      multi_id = multi_id[0]
-      cur.execute('DELETE FROM ' + names['multitags_multitags'] + ' WHERE first_tag_id = %s OR second_tag_id = %s', (multi_id, multi_id))
-      cur.execute('DELETE FROM ' + names['tagged_multitags'] + ' WHERE tag_id = %s', (multi_id,))
-      cur.execute('DELETE FROM ' + names['multitags'] + ' WHERE id = %s', (multi_id,))
-
-    # Valuetags
-    for tag in value:
-      cur.execute('SELECT id FROM ' + names['valuetags'] + ' WHERE name = %s AND value = %s', (tag['name'], tag['value']))
-      value_id = cur.fetchone()
-      if not value_id:
-        continue
-      value_id = value_id[0]
-      cur.execute('DELETE FROM ' + names['tagged_valuetags'] + ' WHERE id = %s', (value_id,))
-      cur.execute('DELETE FROM ' + names['valuetags'] + ' WHERE id = %s', (value_id,))
-
-    conn.commit()
+    refresh_ids = _search_engine_ids_with_multitags(multi) + _search_engine_ids_with_valuetags([(tag['name'], tag['value']) for tag in value])
+    _retry_on_deadlock(conn, lambda: _delete_tags(cur, names, multi, value))
+    _commit(conn)
+    _refresh_search_engine(conn, refresh_ids)
   finally:
     if cur:
       cur.close()
     if conn:
-      conn.close()
+      close_connection(conn)
+
+# Runs a fixed amount of statements, no matter how many tags are given.
+# The tags are locked before any of their bridge rows are deleted, like untagging does (see _lock_removal_candidates).
+def _delete_tags(cur, names, multi, value):
+  if len(multi) > 0:
+    _lock_closure(cur, names)
+
+  multi_ids = _select_multitag_ids(cur, names, set(multi))
+  value_ids = _select_valuetag_ids(cur, names, set((tag['name'], tag['value']) for tag in value))
+  _lock_rows(cur, names, 'valuetags', list(value_ids.values()))
+  _lock_rows(cur, names, 'multitags', list(multi_ids.values()))
+
+  # Multitags. Their closure rows go with them through ON DELETE CASCADE, what's left is recomputing their ancestors
+  if len(multi_ids) > 0:
+    ids = sorted(multi_ids.values())
+    closure_ancestor_ids = set(_with_closure_ancestors(cur, names, ids)) - set(ids)
+    cur.execute('DELETE FROM ' + names['multitags_multitags'] + ' WHERE first_tag_id = ANY(%s) OR second_tag_id = ANY(%s)', (ids, ids))
+    cur.execute('DELETE FROM ' + names['tagged_multitags'] + ' WHERE tag_id = ANY(%s)', (ids,))
+    cur.execute('DELETE FROM ' + names['multitags'] + ' WHERE id = ANY(%s)', (ids,))
+    for tag in multi_ids:
+      _invalidate_tag_id(('multi', tag))
+    _rebuild_closure(cur, names, closure_ancestor_ids)
+
+  # Valuetags
+  if len(value_ids) > 0:
+    ids = sorted(value_ids.values())
+    cur.execute('DELETE FROM ' + names['tagged_valuetags'] + ' WHERE tag_id = ANY(%s)', (ids,))
+    cur.execute('DELETE FROM ' + names['valuetags'] + ' WHERE id = ANY(%s)', (ids,))
+    for tag in value_ids:
+      _invalidate_tag_id(('value', tag[0], tag[1]))
@@ -0,0 +1,122 @@
+import bisect
+import threading
+
+# Minimal Prometheus style metrics, rendered in the text exposition format by render().
+#
+# Every metric is a family of series keyed by a tuple of label values. Recording a value costs a dict lookup
+# and a few additions under a lock, so instrumentation can stay on in production.
+
+# Seconds. Covers everything from cached lookups to slow searches
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _escape(value):
+  return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _labels(names, values, extra=None):
+  pairs = ['{}="{}"'.format(name, _escape(value)) for name, value in zip(names, values)]
+  if extra is not None:
+    pairs.append('{}="{}"'.format(extra[0], _escape(extra[1])))
+  return '{' + ','.join(pairs) + '}' if len(pairs) > 0 else ''
+
+def _number(value):
+  if value == float('inf'):
+    return '+Inf'
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+  def __init__(self, name, documentation, labels=()):
+    self.name = name
+    self.documentation = documentation
+    self.labels = tuple(labels)
+    self._values = {}
+    self._lock = threading.Lock()
+
+  def inc(self, labels=(), amount=1):
+    with self._lock:
+      self._values[labels] = self._values.get(labels, 0) + amount
+
+  def render(self):
+    lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} counter'.format(self.name)]
+    with self._lock:
+      for labels in sorted(self._values):
+        lines.append(self.name + _labels(self.labels, labels) + ' ' + _number(self._values[labels]))
+    return lines
+
+# Values computed when rendered, for state that's already tracked elsewhere (e.g. the connection pool size)
+class Gauge:
+  def __init__(self, name, documentation, collect, labels=()):
+    self.name = name
+    self.documentation = documentation
+    self.labels = tuple(labels)
+    self._collect = collect # FUNCTION() -> {label values tuple: value}
+
+  def render(self):
+    lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} gauge'.format(self.name)]
+    values = self._collect()
+    for labels in sorted(values):
+      lines.append(self.name + _labels(self.labels, labels) + ' ' + _number(values[labels]))
+    return lines
+
+class Histogram:
+  def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+    self.name = name
+    self.documentation = documentation
+    self.labels = tuple(labels)
+    self.buckets = tuple(sorted(buckets))
+    self._values = {} # labels -> [per bucket counts (not cumulative), +Inf count, sum]
+    self._lock = threading.Lock()
+
+  def observe(self, labels, value):
+    i = bisect.bisect_left(self.buckets, value)
+    with self._lock:
+      series = self._values.get(labels)
+      if series is None:
+        series = self._values[labels] = [[0] * len(self.buckets), 0, 0.0]
+      if i < len(self.buckets):
+        series[0][i] += 1
+      else:
+        series[1] += 1
+      series[2] += value
+
+  def render(self):
+    lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} histogram'.format(self.name)]
+    with self._lock:
+      for labels in sorted(self._values):
+        counts, overflow, total = self._values[labels]
+        cumulative = 0
+        for bucket, count in zip(self.buckets, counts):
+          cumulative += count
+          lines.append(self.name + '_bucket' + _labels(self.labels, labels, ('le', _number(bucket))) + ' ' + str(cumulative))
+        cumulative += overflow
+        lines.append(self.name + '_bucket' + _labels(self.labels, labels, ('le', '+Inf')) + ' ' + str(cumulative))
+        lines.append(self.name + '_sum' + _labels(self.labels, labels) + ' ' + repr(total))
+        lines.append(self.name + '_count' + _labels(self.labels, labels) + ' ' + str(cumulative))
+    return lines
+
+_REGISTRY = []
+_REGISTRY_LOCK = threading.Lock()
+
+def register(metric):
+  with _REGISTRY_LOCK:
+    _REGISTRY.append(metric)
+  return metric
+
+def render():
+  with _REGISTRY_LOCK:
+    registry = list(_REGISTRY)
+
+  lines = []
+  for metric in registry:
+    lines += metric.render()
+  return '\n'.join(lines) + '\n'
+
+REQUESTS = register(Counter('tmv_http_requests_total', 'Handled HTTP requests', ('route', 'method', 'status')))
+REQUEST_SECONDS = register(Histogram('tmv_http_request_duration_seconds', 'Time from receiving an HTTP request to starting its response', ('route', 'method')))
+ERRORS = register(Counter('tmv_errors_total', 'Error responses by TMVException id (-1 for unknown errors)', ('error_id',)))
+
+DB_STATEMENT_SECONDS = register(Histogram('tmv_db_statement_duration_seconds', 'Time spent executing database statements', ('function', 'verb')))
+DB_STATEMENT_ROWS = register(Counter('tmv_db_statement_rows_total', 'Rows returned or affected by database statements', ('function', 'verb')))
+DB_STATEMENT_ERRORS = register(Counter('tmv_db_statement_errors_total', 'Database statements that raised an error', ('function', 'verb')))
+DB_ACQUIRE_SECONDS = register(Histogram('tmv_db_connection_acquire_duration_seconds', 'Time spent waiting for a connection from the pool'))
+
+ORPHANS_DELETED = register(Counter('tmv_orphans_deleted_total', 'Unused rows deleted by the orphan sweeper', ('table',)))
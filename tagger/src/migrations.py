@@ -0,0 +1,227 @@
+import psycopg2
+import time
+import database
+
+# Arbitrary key for the advisory lock that keeps concurrently starting taggers from migrating at the same time
+_LOCK_KEY = 7391
+_LOCK_POLL_INTERVAL = 1
+
+# Blocking in pg_advisory_lock() would hold a snapshot while waiting, which CREATE INDEX CONCURRENTLY in the tagger
+# holding the lock waits for, deadlocking the two. Polling only holds one for the instant of each attempt.
+def _acquire_lock(cur):
+  while True:
+    cur.execute('SELECT pg_try_advisory_lock(%s)', (_LOCK_KEY,))
+    if cur.fetchone()[0]:
+      return
+    time.sleep(_LOCK_POLL_INTERVAL)
+
+def _index_name(names, table, suffix):
+  return names[table].split('.', 1)[1] + '_' + suffix
+
+# A failed concurrent build leaves an invalid index behind, which IF NOT EXISTS would then skip forever
+def _drop_invalid_index(cur, names, index):
+  cur.execute("""
+SELECT i.indisvalid FROM pg_index AS i
+  JOIN pg_class AS c ON c.oid = i.indexrelid
+  JOIN pg_namespace AS n ON n.oid = c.relnamespace
+  WHERE n.nspname = %s AND c.relname = %s""", (names['schema'], index))
+  row = cur.fetchone()
+  if row and not row[0]:
+    cur.execute('DROP INDEX CONCURRENTLY IF EXISTS ' + names['schema'] + '.' + index)
+
+def _create_index_concurrently(cur, names, table, suffix, definition):
+  index = _index_name(names, table, suffix)
+  _drop_invalid_index(cur, names, index)
+  cur.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS ' + index + ' ON ' + names[table] + ' ' + definition)
+
+def _index_tagged_multitags_tag_id(cur, names):
+  _create_index_concurrently(cur, names, 'tagged_multitags', 'tag_id_idx', '(tag_id)')
+
+def _index_tagged_valuetags_tag_id(cur, names):
+  _create_index_concurrently(cur, names, 'tagged_valuetags', 'tag_id_idx', '(tag_id)')
+
+def _index_multitags_multitags_second_tag_id(cur, names):
+  _create_index_concurrently(cur, names, 'multitags_multitags', 'second_tag_id_idx', '(second_tag_id)')
+
+# Plain search terms are matched against the concatenated '<name><value>' form of valuetags. The expression has to be
+# written exactly like database._fullname() for the planner to use these indexes.
+_FULLNAME = '(name || CAST(value AS text))'
+
+# text_pattern_ops lets both '=' and LIKE patterns with a literal prefix use the index
+def _index_valuetags_fullname(cur, names):
+  _create_index_concurrently(cur, names, 'valuetags', 'fullname_expr_pattern_idx', '(' + _FULLNAME + ' text_pattern_ops)')
+
+def _index_valuetags_fullname_trigrams(cur, names):
+  _create_index_concurrently(cur, names, 'valuetags', 'fullname_expr_trgm_idx', 'USING gin (' + _FULLNAME + ' gin_trgm_ops)')
+
+def _index_multitags_value_pattern(cur, names):
+  _create_index_concurrently(cur, names, 'multitags', 'value_pattern_idx', '(value text_pattern_ops)')
+
+# Trigram indexes let LIKE patterns with leading wildcards ('%cat%') use an index.
+# pg_trgm is optional, without it wildcard searches fall back to scanning the tag tables.
+def _index_trigrams(cur, names):
+  cur.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+  if cur.fetchone() is None:
+    print('The pg_trgm extension is not available, wildcard searches will not be trigram indexed')
+    return False
+
+  try:
+    cur.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+  except psycopg2.Error as e:
+    print('Failed to create the pg_trgm extension, wildcard searches will not be trigram indexed: {}'.format(e))
+    return False
+
+  _create_index_concurrently(cur, names, 'multitags', 'value_trgm_idx', 'USING gin (value gin_trgm_ops)')
+  _index_valuetags_fullname_trigrams(cur, names)
+
+# Databases that applied version 4 still carry the stored fullname column. Index the expression first, so searches
+# stay indexed throughout, then drop the column, which doesn't rewrite the table and takes its indexes with it.
+# The trigram index is only built if pg_trgm is installed, otherwise version 7 builds it once it is.
+def _drop_valuetags_fullname(cur, names):
+  _index_valuetags_fullname(cur, names)
+  cur.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+  if cur.fetchone() is not None:
+    _index_valuetags_fullname_trigrams(cur, names)
+  cur.execute('ALTER TABLE ' + names['valuetags'] + ' DROP COLUMN IF EXISTS fullname')
+
+# See the closure functions in database.py
+def _create_multitags_closure(cur, names):
+  cur.execute('CREATE TABLE IF NOT EXISTS ' + names['multitags_closure'] + ' (ancestor_id bigint NOT NULL REFERENCES ' + names['multitags'] + '(id) ON DELETE CASCADE, descendant_id bigint NOT NULL REFERENCES ' + names['multitags'] + '(id) ON DELETE CASCADE, PRIMARY KEY(ancestor_id, descendant_id))')
+  cur.execute('CREATE INDEX IF NOT EXISTS ' + _index_name(names, 'multitags_closure', 'descendant_id_idx') + ' ON ' + names['multitags_closure'] + ' (descendant_id)')
+  cur.execute("""
+WITH RECURSIVE reachable(ancestor_id, descendant_id) AS (
+  SELECT mm.first_tag_id, mm.second_tag_id FROM """ + names['multitags_multitags'] + """ AS mm
+  UNION
+  SELECT r.ancestor_id, mm.second_tag_id FROM reachable AS r
+    JOIN """ + names['multitags_multitags'] + """ AS mm ON mm.first_tag_id = r.descendant_id
+)
+INSERT INTO """ + names['multitags_closure'] + """ (ancestor_id, descendant_id)
+SELECT ancestor_id, descendant_id FROM reachable WHERE ancestor_id <> descendant_id
+ON CONFLICT DO NOTHING""")
+
+# Version 9 kept a count of uses on every tag and tagged value, updated by triggers on the bridge tables. Tagging then had
+# to lock the tags it used until it committed, which serialized all tagging with popular tags. Whether a row is unused is
+# found by probing the bridge table indexes instead now (see database._unused), so the counters and triggers are dropped.
+_COUNTED_BRIDGES = ['tagged_multitags', 'tagged_valuetags', 'multitags_multitags']
+
+def _drop_usage_counters(cur, names):
+  for bridge in _COUNTED_BRIDGES:
+    for event in ['insert', 'delete', 'update']:
+      cur.execute('DROP TRIGGER IF EXISTS count_' + event + ' ON ' + names[bridge])
+      cur.execute('DROP FUNCTION IF EXISTS ' + names['schema'] + '.' + _index_name(names, bridge, 'count_' + event) + '()')
+
+  # Takes the indexes of unused rows with them. Dropping a column doesn't rewrite the table.
+  cur.execute('ALTER TABLE ' + names['tagged'] + ' DROP COLUMN IF EXISTS tag_count')
+  cur.execute('ALTER TABLE ' + names['multitags'] + ' DROP COLUMN IF EXISTS use_count')
+  cur.execute('ALTER TABLE ' + names['valuetags'] + ' DROP COLUMN IF EXISTS use_count')
+
+# Every migration is applied exactly once per database, in order of version.
+#
+# [{
+#   'version': INTEGER,
+#   'name': STRING,
+#   'transaction': BOOLEAN, # False runs the migration in autocommit mode, which e.g. CREATE INDEX CONCURRENTLY requires
+#   'apply': FUNCTION(cur, names) # Returning False leaves the migration unapplied, so it's retried on the next startup
+# }, ...]
+MIGRATIONS = [{
+  'version': 1,
+  'name': 'Index tagged multitags by tag',
+  'transaction': False,
+  'apply': _index_tagged_multitags_tag_id
+}, {
+  'version': 2,
+  'name': 'Index tagged valuetags by tag',
+  'transaction': False,
+  'apply': _index_tagged_valuetags_tag_id
+}, {
+  'version': 3,
+  'name': 'Index implied multitags by implied tag',
+  'transaction': False,
+  'apply': _index_multitags_multitags_second_tag_id
+}, {
+  'version': 5,
+  'name': 'Index valuetags by fullname',
+  'transaction': False,
+  'apply': _index_valuetags_fullname
+}, {
+  'version': 6,
+  'name': 'Index multitags by value patterns',
+  'transaction': False,
+  'apply': _index_multitags_value_pattern
+}, {
+  'version': 7,
+  'name': 'Index multitags and valuetags by trigrams',
+  'transaction': False,
+  'apply': _index_trigrams
+}, {
+  'version': 8,
+  'name': 'Create multitags closure',
+  'transaction': True,
+  'apply': _create_multitags_closure
+}, {
+  'version': 11,
+  'name': 'Replace valuetags fullname column with expression indexes',
+  'transaction': False,
+  'apply': _drop_valuetags_fullname
+}, {
+  'version': 12,
+  'name': 'Drop usage counters',
+  'transaction': True,
+  'apply': _drop_usage_counters
+}]
+# Version 4 is taken: it added the stored fullname column that version 11 drops again.
+# Versions 9 and 10 are taken: they added usage counters and indexed the unused rows by them, which version 12 drops again.
+
+def _record(cur, names, migration):
+  cur.execute('INSERT INTO ' + names['migrations'] + ' (version, name) VALUES (%s, %s)', (migration['version'], migration['name']))
+
+def _apply(conn, cur, names, migration):
+  print('Applying migration {}: {}'.format(migration['version'], migration['name']))
+
+  if not migration['transaction']:
+    if migration['apply'](cur, names) is not False:
+      _record(cur, names, migration)
+    return
+
+  conn.autocommit = False
+  try:
+    if migration['apply'](cur, names) is False:
+      conn.rollback()
+    else:
+      _record(cur, names, migration)
+      conn.commit()
+  except BaseException:
+    conn.rollback()
+    raise
+  finally:
+    conn.autocommit = True
+
+# Brings the database schema up to date. Expects create_tables() to have been run
+def migrate():
+  conn = None
+  cur = None
+  locked = False
+
+  try:
+    conn = database.open_connection()
+    conn.autocommit = True
+    cur = conn.cursor()
+    names = database.get_table_names()
+
+    cur.execute('CREATE TABLE IF NOT EXISTS ' + names['migrations'] + ' (version integer PRIMARY KEY, name text NOT NULL, applied_at timestamptz NOT NULL DEFAULT now())')
+    _acquire_lock(cur)
+    locked = True
+
+    cur.execute('SELECT version FROM ' + names['migrations'])
+    applied = set(row[0] for row in cur.fetchall())
+
+    for migration in sorted(MIGRATIONS, key=lambda m: m['version']):
+      if migration['version'] not in applied:
+        _apply(conn, cur, names, migration)
+  finally:
+    if cur:
+      if locked:
+        cur.execute('SELECT pg_advisory_unlock(%s)', (_LOCK_KEY,))
+      cur.close()
+    if conn:
+      database.close_connection(conn)
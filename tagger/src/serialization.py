@@ -0,0 +1,91 @@
+import json
+
+# orjson and msgpack are optional. Without orjson the standard library json module is used,
+# and without msgpack MessagePack requests are refused.
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+
+from TMVException import TMVException
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+# application/x-msgpack is what most MessagePack clients still send
+_MEDIA_TYPES = {
+  'application/json': JSON,
+  'application/msgpack': MSGPACK,
+  'application/x-msgpack': MSGPACK
+}
+
+def dumps_json(value):
+  if orjson is not None:
+    return orjson.dumps(value)
+  return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+def loads_json(body):
+  if orjson is not None:
+    return orjson.loads(body)
+  return json.loads(body)
+
+def _dumps_msgpack(value):
+  return msgpack.packb(value, use_bin_type=True)
+
+def _loads_msgpack(body):
+  return msgpack.unpackb(body, raw=False)
+
+def _media_type(header):
+  return header.split(';', 1)[0].strip().lower()
+
+def supported():
+  return [JSON] + ([MSGPACK] if msgpack is not None else [])
+
+# Bodies are JSON unless the Content-Type says MessagePack, so clients that don't set it keep working.
+# An empty body is None, like an empty JSON body used to be.
+def decode(body, content_type):
+  format = _MEDIA_TYPES.get(_media_type(content_type or ''), JSON)
+  if format == MSGPACK and msgpack is None:
+    raise TMVException(TMVException.ID_PARSE_JSON, 'MessagePack request bodies are not supported by this tagger')
+  if not body:
+    return None
+
+  try:
+    return _loads_msgpack(body) if format == MSGPACK else loads_json(body)
+  except Exception:
+    raise TMVException(TMVException.ID_PARSE_JSON, 'Couldn\'t parse request body as {}'.format('MessagePack' if format == MSGPACK else 'JSON'))
+
+# Picks the supported format with the highest quality in an Accept header. Anything else gets JSON
+def negotiate(accept):
+  best = JSON
+  best_quality = 0
+  for part in (accept or '').split(','):
+    params = part.split(';')
+    format = _MEDIA_TYPES.get(params[0].strip().lower())
+    if format is None or format not in supported():
+      continue
+
+    quality = 1.0
+    for param in params[1:]:
+      key, _, value = param.partition('=')
+      if key.strip() == 'q':
+        try:
+          quality = float(value)
+        except ValueError:
+          quality = 0
+    if quality > best_quality:
+      best = format
+      best_quality = quality
+  return best
+
+# Returns (body, content type)
+def encode(value, accept):
+  format = negotiate(accept)
+  if format == MSGPACK:
+    return _dumps_msgpack(value), MSGPACK
+  return dumps_json(value), JSON
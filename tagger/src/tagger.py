@@ -1,148 +1,233 @@
 from sanic import Sanic
-from sanic.response import json
+from sanic.response import raw, text
 from sanic.exceptions import NotFound, MethodNotSupported
 
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import base64
+import binascii
+import functools
+import time
 import traceback
 
 import database
+import dotenv
+import metrics
+import migrations
+import serialization
+from validators import compile_input
 from TMVException import TMVException
 
 app = Sanic('tmv-tagger')
 
-def error(error_id, error_msg):
-  return json({
+# The database module is blocking, so every call to it is run on this executor instead of the event loop
+_DB_EXECUTOR = None
+
+# A streamed response holds a pooled connection until the client has read all of it, so slow clients could otherwise
+# take every connection. Streams beyond TMV_TAGGER_MAX_STREAMS wait for a running one to finish
+_STREAMS = None
+
+async def run_db(func, *args):
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(_DB_EXECUTOR, functools.partial(func, *args))
+
+# Request and response bodies are JSON, or MessagePack if the client asks for it, see serialization.py
+def parse_body(request):
+  return serialization.decode(request.body, request.headers.get('content-type'))
+
+def respond(request, body):
+  content, content_type = serialization.encode(body, request.headers.get('accept'))
+  return raw(content, content_type=content_type)
+
+def error(request, error_id, error_msg):
+  metrics.ERRORS.inc((error_id,))
+  return respond(request, {
     'error_id': error_id,
     'error_msg': error_msg
   })
 
-def unknown_error(exception):
+# Search cursors are opaque to clients
+def encode_cursor(last_id):
+  return base64.urlsafe_b64encode(str(last_id).encode('ascii')).decode('ascii')
+
+def decode_cursor(cursor):
+  try:
+    return int(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('ascii'))
+  except (ValueError, UnicodeError, binascii.Error):
+    raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'cursor\' is not a valid cursor')
+
+# Sends the batches yielded by a database generator as a JSON array, one chunk per batch.
+# Streamed responses are always JSON, since MessagePack needs the length of an array before its elements.
+# The first batch is fetched before the response is started, so errors up until then are reported as usual.
+# Later errors can't be, since the status has been sent already: the connection is closed before the end of the body instead,
+# which tells the client that the response is incomplete.
+async def stream_json_array(request, batches, prefix, suffix):
+  await stream_json_arrays(request, [(None, batches)], prefix, suffix)
+
+# Same as stream_json_array, but for several arrays one after the other.
+# arrays is a list of (key, generator), where a key that isn't None makes the array a member of the surrounding object.
+async def stream_json_arrays(request, arrays, prefix, suffix):
+  response = None
+  async with _STREAMS:
+    try:
+      batch = await run_db(next, arrays[0][1], None) if len(arrays) > 0 else None
+      response = await request.respond(content_type='application/json')
+      await response.send(prefix)
+
+      for i, (key, batches) in enumerate(arrays):
+        if i > 0:
+          batch = await run_db(next, batches, None)
+        await response.send((b',' if i > 0 else b'') + (serialization.dumps_json(key) + b': ' if key is not None else b'') + b'[')
+
+        first = True
+        while batch is not None:
+          await response.send((b'' if first else b',') + b','.join(serialization.dumps_json(v) for v in batch))
+          first = False
+          batch = await run_db(next, batches, None)
+        await response.send(']')
+
+      await response.send(suffix)
+      await response.eof()
+    except Exception as e:
+      if response is None:
+        raise
+      metrics.ERRORS.inc((-1,))
+      print_exception(e)
+      request.transport.close()
+    finally:
+      for key, batches in arrays:
+        await run_db(batches.close)
+
+def print_exception(exception):
   print(traceback.print_exception(type(exception), exception, exception.__traceback__))
-  return error(-1, 'Unknown error occured. Error type: \'{}\''.format(type(exception).__name__))
-
-# Expected format:
-#
-# [{
-#   'name': STRING,
-#   'required': BOOLEAN,
-#   'type': STRING,
-#    ?'empty': BOOLEAN
-# }, ...]
-def verify_input(request, expected):
-  names = [e['name'] for e in expected]
-
-  for name in request:
-    if name not in names:
-      raise TMVException(TMVException.ID_FAULTY_INPUT, 'Given parameter \'{}\' not expected'.format(name))
-
-  for e in expected:
-    if not e['name'] in request and e['required']:
-      raise TMVException(TMVException.ID_FAULTY_INPUT, 'Required parameter \'{}\' not found in request body'.format(e['name']))
-    elif not e['name'] in request:
-      continue # Not in request and is optional, no need to check the rest
-
-    param = request[e['name']]
-    if e['type'] == 'str':
-      if not isinstance(param, str):
-        raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'{}\' not a string as expected'.format(e['name']))
-    elif e['type'] == 'bool':
-      if not isinstance(param, bool):
-        raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'{}\' not a boolean as expected'.format(e['name']))
-    elif e['type'] == 'str[]':
-      if not isinstance(param, list):
-        raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'{}\' not a string array as expected'.format(e['name']))
-      elif len(param) < 1 and not e['empty']:
-        raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'{}\' cannot be empty'.format(e['name']))
-      else:
-        for v in param:
-          if not isinstance(v, str):
-            raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'{}\' not a string array as expected'.format(e['name']))
-    elif e['type'] == 'str:str[]':
-      if not isinstance(param, dict):
-        raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'{}\' not a STRING: STRING[] dict as expectd'.format(e['name']))
-      if len(param) < 1 and not e['empty']:
-        raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'{}\' cannot be empty'.format(e['name']))
-      for k in param:
-        if not isinstance(k, str):
-          raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'{}\' not a STRING: STRING[] dict as expectd'.format(e['name']))
-        v = param[k]
-        if not isinstance(v, list):
-          raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'{}\' not a STRING: STRING[] dict as expectd'.format(e['name']))
-        if len(v) < 1 and not e['empty']:
-          raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'{}\' cannot have empty value lists'.format(e['name']))
-        for s in v:
-          if not isinstance(s, str):
-            raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'{}\' not a STRING: STRING[] dict as expectd'.format(e['name']))
-    elif e['type'] == 'str,str[]':
-      if not isinstance(param, str):
-        if not isinstance(param, list):
-          raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'{}\' not a string or string array as expected'.format(e['name']))
-        elif len(param) < 1 and not e['empty']:
-          raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'{}\' cannot be empty'.format(e['name']))
-        else:
-          for v in param:
-            if not isinstance(v, str):
-              raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'{}\' not a string or string array as expected'.format(e['name']))
-    elif e['type'] == 'val[]':
-      if not isinstance(param, list):
-        raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'{}\' not an array as expected'.format(e['name']))
-      elif len(param) < 1 and not e['empty']:
-        raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'{}\' cannot be empty'.format(e['name']))
-      else:
-        for v in param:
-          if not isinstance(v, dict):
-            raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'{}\' not an array of objects as expected'.format(e['name']))
-          elif 'name' not in v or 'value' not in v:
-            raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'{}\' not an array of objects formatted as expected'.format(e['name']))
-          elif not isinstance(v['name'], str) or not isinstance(v['value'], int):
-            raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'{}\' not an array of objects formatted as expected'.format(e['name']))
-    elif e['type'] == 'qtag[]':
-      if not isinstance(param, list):
-        raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'{}\' not an array as expected'.format(e['name']))
-      elif len(param) < 1 and not e['empty']:
-        raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'{}\' cannot be empty'.format(e['name']))
-      else:
-        for v in param:
-          if not v in ['value', 'multi']:
-            raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'{}\' can only contain \'value\', or \'multi\''.format(e['name']))
 
+def unknown_error(request, exception):
+  print_exception(exception)
+  return error(request, -1, 'Unknown error occured. Error type: \'{}\''.format(type(exception).__name__))
 
 # Expected request format:
 #
 # {
-#   'query': STRING[]
+#   'query': STRING[],
+#   ?'limit': INTEGER,
+#   ?'cursor': STRING,
+#   ?'stream': BOOLEAN,
+#   ?'explain': BOOLEAN, # Only allowed if TMV_TAGGER_SEARCH_EXPLAIN is true
+#   ?'facets': INTEGER, # Also count the tags of all matches, returning this many of the most common ones
+#   ?'facet_sample': INTEGER # Percentage of the tagged values to count facets over, estimating the counts. Requires 'facets'
 # }
 #
 # Expected response:
 #
 # {
-#   ?'response': {
-#     ?'value': [{'name': STRING, 'value': INTEGER}, ...]
-#     ?'multi': STRING[]
+#   ?'response': STRING[],
+#   ?'cursor': STRING, # Only if 'limit' is given. null when there are no more results
+#   ?'explain': { # Only if 'explain' is given
+#     'terms': [{'term': STRING, 'negated': BOOLEAN, 'sql': STRING, 'rows': INTEGER, 'ms': FLOAT}, ...],
+#     'sql': ?STRING,
+#     'ms': ?FLOAT,
+#     'plan': ?<EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) output>
+#   },
+#   ?'facets': { # Only if 'facets' is given. Counted over every match, not just the returned page
+#     'total': INTEGER,
+#     'sampled': BOOLEAN, # Whether the counts are estimates from 'facet_sample'
+#     'multi_tags': [{'tag': STRING, 'count': INTEGER}, ...],
+#     'value_tags': [{'name': STRING, 'count': INTEGER}, ...]
 #   },
 #   ?'error_id': INTEGER,
 #   ?'error_msg': STRING,
 # }
+verify_search_input = compile_input([{
+  'name': 'query',
+  'required': True,
+  'type': 'str[]',
+  'empty': False
+}, {
+  'name': 'limit',
+  'required': False,
+  'type': 'int',
+  'min': 1
+}, {
+  'name': 'cursor',
+  'required': False,
+  'type': 'str'
+}, {
+  'name': 'stream',
+  'required': False,
+  'type': 'bool'
+}, {
+  'name': 'explain',
+  'required': False,
+  'type': 'bool'
+}, {
+  'name': 'facets',
+  'required': False,
+  'type': 'int',
+  'min': 1,
+  'max': 1000
+}, {
+  'name': 'facet_sample',
+  'required': False,
+  'type': 'int',
+  'min': 1,
+  'max': 100
+}])
+
 @app.route('/search', methods=['POST'])
 async def search(request):
   try:
-    request_body = request.json
-  except Exception as e:
-    return error(TMVException.ID_PARSE_JSON, 'Couldn\'t parse request body as JSON')
+    request_body = parse_body(request)
+  except TMVException as e:
+    return error(request, e.error_id, e.error_msg)
 
   try:
-    verify_input(request_body, [{
-      'name': 'query',
-      'required': True,
-      'type': 'str[]',
-      'empty': False
-    }])
-
-    result = database.search(request_body['query'])
-    return json({'response': result})
+    verify_search_input(request_body)
+
+    limit   = request_body['limit'  ] if 'limit'   in request_body else None
+    cursor  = request_body['cursor' ] if 'cursor'  in request_body else None
+    stream  = request_body['stream' ] if 'stream'  in request_body else False
+    explain = request_body['explain'] if 'explain' in request_body else False
+    facets  = request_body['facets' ] if 'facets'  in request_body else None
+    sample  = request_body['facet_sample'] if 'facet_sample' in request_body else None
+
+    if sample is not None and facets is None:
+      raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'facet_sample\' requires \'facets\'')
+
+    if explain:
+      # EXPLAIN ANALYZE runs the search again, and shows the database layout, so it's off unless enabled
+      if dotenv.read()['TMV_TAGGER_SEARCH_EXPLAIN'] != 'true':
+        raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'explain\' is disabled, see TMV_TAGGER_SEARCH_EXPLAIN')
+      if stream:
+        raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'explain\' cannot be combined with \'stream\'')
+
+    if stream:
+      if limit is not None or cursor is not None:
+        raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'stream\' cannot be combined with \'limit\' or \'cursor\'')
+      if facets is not None:
+        raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'stream\' cannot be combined with \'facets\'')
+      batches = database.search_stream(request_body['query'], int(dotenv.read()['TMV_TAGGER_STREAM_BATCH_SIZE']))
+      return await stream_json_array(request, batches, '{"response": ', '}')
+
+    if cursor is not None and limit is None:
+      raise TMVException(TMVException.ID_FAULTY_INPUT, 'Parameter \'cursor\' requires \'limit\'')
+    after_id = decode_cursor(cursor) if cursor is not None else None
+
+    if explain:
+      result, last_id, explained = await run_db(database.explain_search, request_body['query'], limit, after_id)
+      retval = {'response': result, 'explain': explained}
+    else:
+      result, last_id = await run_db(database.search, request_body['query'], limit, after_id)
+      retval = {'response': result}
+
+    if limit is not None:
+      retval['cursor'] = encode_cursor(last_id) if last_id is not None else None
+    if facets is not None:
+      retval['facets'] = await run_db(database.search_facets, request_body['query'], facets, sample)
+    return respond(request, retval)
   except TMVException as e:
-    return error(e.error_id, e.error_msg)
+    return error(request, e.error_id, e.error_msg)
   except Exception as e:
-    return unknown_error(e)
+    return unknown_error(request, e)
 
 # Expected request format:
 #
@@ -167,77 +252,110 @@ async def search(request):
 #   ?'error_id': INTEGER,
 #   ?'error_msg': STRING,
 # }
+verify_get_input = compile_input([{
+  'name': 'value',
+  'required': True,
+  'type': 'str,str[]',
+  'empty': False
+}, {
+  'name': 'tags',
+  'required': False,
+  'type': 'qtag[]',
+  'empty': False
+}])
+
 @app.route('/get', methods=['POST'])
 async def get(request):
   try:
-    request_body = request.json
-  except Exception as e:
-    return error(TMVException.ID_PARSE_JSON, 'Couldn\'t parse request body as JSON')
+    request_body = parse_body(request)
+  except TMVException as e:
+    return error(request, e.error_id, e.error_msg)
 
   try:
-    verify_input(request_body, [{
-      'name': 'value',
-      'required': True,
-      'type': 'str,str[]',
-      'empty': False
-    }, {
-      'name': 'tags',
-      'required': False,
-      'type': 'qtag[]',
-      'empty': False
-    }])
+    verify_get_input(request_body)
 
     tags = request_body['tags'] if 'tags' in request_body else None
     value = True if tags is None or 'value' in tags else False
     multi = True if tags is None or 'multi' in tags else False
 
     tagged = request_body['value'] if isinstance(request_body['value'], list) else [request_body['value']]
-    result = database.get(tagged, value, multi)
-    return json({'response': result})
+    result = await run_db(database.get, tagged, value, multi)
+    return respond(request, {'response': result})
   except TMVException as e:
-    return error(e.error_id, e.error_msg)
+    return error(request, e.error_id, e.error_msg)
   except Exception as e:
-    return unknown_error(e)
+    return unknown_error(request, e)
 
 # Expected request format:
 #
 # {
-#   'tags': [?'multi', ?'value']
+#   'tags': [?'multi', ?'value'],
+#   ?'prefix': STRING, # Matches multitags by value, and valuetags by '<name><value>'
+#   ?'limit': INTEGER, # Per tag type
+#   ?'stream': BOOLEAN
 # }
 #
 # Expected response
 #
 # {
 #   ?'response': {
-#     'multi_tags': STRING[],
-#     'value_tags': [{'name': STRING, 'value': INTEGER}, ...]
+#     ?'multi_tags': STRING[],
+#     ?'value_tags': [{'name': STRING, 'value': INTEGER}, ...]
 #   },
 #   ?'error_id': INTEGER,
 #   ?'error_msg': STRING,
 # }
+verify_get_tags_input = compile_input([{
+  'name': 'tags',
+  'required': True,
+  'type': 'qtag[]',
+  'empty': False
+}, {
+  'name': 'prefix',
+  'required': False,
+  'type': 'str'
+}, {
+  'name': 'limit',
+  'required': False,
+  'type': 'int',
+  'min': 1
+}, {
+  'name': 'stream',
+  'required': False,
+  'type': 'bool'
+}])
+
 @app.route('/get-tags', methods=['POST'])
 async def get_tags(request):
   try:
-    request_body = request.json
-  except Exception as e:
-    return error(TMVException.ID_PARSE_JSON, 'Couldn\'t parse request body as JSON')
+    request_body = parse_body(request)
+  except TMVException as e:
+    return error(request, e.error_id, e.error_msg)
 
   try:
-    verify_input(request_body, [{
-      'name': 'tags',
-      'required': True,
-      'type': 'qtag[]',
-      'empty': False
-    }])
-
-    multi = 'multi' in request_body['tags']
-    value = 'value' in request_body['tags']
-    retval = database.get_tags(multi, value)
-    return json({'response': retval})
+    verify_get_tags_input(request_body)
+
+    multi  = 'multi' in request_body['tags']
+    value  = 'value' in request_body['tags']
+    prefix = request_body['prefix'] if 'prefix' in request_body else None
+    limit  = request_body['limit' ] if 'limit'  in request_body else None
+    stream = request_body['stream'] if 'stream' in request_body else False
+
+    if stream:
+      batch_size = int(dotenv.read()['TMV_TAGGER_STREAM_BATCH_SIZE'])
+      arrays = []
+      if multi:
+        arrays.append(('multi_tags', database.get_tags_stream('multi', prefix, limit, batch_size)))
+      if value:
+        arrays.append(('value_tags', database.get_tags_stream('value', prefix, limit, batch_size)))
+      return await stream_json_arrays(request, arrays, '{"response": {', '}}')
+
+    retval = await run_db(database.get_tags, multi, value, prefix, limit)
+    return respond(request, {'response': retval})
   except TMVException as e:
-    return error(e.error_id, e.error_msg)
+    return error(request, e.error_id, e.error_msg)
   except Exception as e:
-    return unknown_error(e)
+    return unknown_error(request, e)
 
 # Expected request format:
 #
@@ -254,39 +372,88 @@ async def get_tags(request):
 #   ?'error_id': INTEGER,
 #   ?'error_msg': STRING,
 # }
+verify_tag_input = compile_input([{
+  'name': 'value',
+  'required': True,
+  'type': 'str',
+}, {
+  'name': 'multi_tags',
+  'required': False,
+  'type': 'str[]',
+  'empty': False
+}, {
+  'name': 'value_tags',
+  'required': False,
+  'type': 'val[]',
+  'empty': False
+}])
+
 @app.route('/tag', methods=['POST'])
 async def tag(request):
   try:
-    request_body = request.json
-  except Exception as e:
-    return error(TMVException.ID_PARSE_JSON, 'Couldn\'t parse request body as JSON')
+    request_body = parse_body(request)
+  except TMVException as e:
+    return error(request, e.error_id, e.error_msg)
 
   try:
-    verify_input(request_body, [{
-      'name': 'value',
-      'required': True,
-      'type': 'str',
-    }, {
-      'name': 'multi_tags',
-      'required': False,
-      'type': 'str[]',
-      'empty': False
-    }, {
-      'name': 'value_tags',
-      'required': False,
-      'type': 'val[]',
-      'empty': False
-    }])
+    verify_tag_input(request_body)
 
     value_tags = request_body['value_tags'] if 'value_tags' in request_body else []
     multi_tags = request_body['multi_tags'] if 'multi_tags' in request_body else []
 
-    database.tag(request_body['value'], value_tags, multi_tags)
-    return json({'success': True})
+    await run_db(database.tag, request_body['value'], value_tags, multi_tags)
+    return respond(request, {'success': True})
+  except TMVException as e:
+    return error(request, e.error_id, e.error_msg)
+  except Exception as e:
+    return unknown_error(request, e)
+
+# Expected request format:
+#
+# {
+#   'values': [{
+#     'value': STRING,
+#     ?'multi_tags': STRING[],
+#     ?'value_tags': [{'name': STRING, 'value': NUMBER}, ...]
+#   }, ...]
+# }
+#
+# Expected response:
+#
+# {
+#   ?'success': BOOLEAN,
+#   ?'error_id': INTEGER,
+#   ?'error_msg': STRING,
+# }
+verify_tag_batch_input = compile_input([{
+  'name': 'values',
+  'required': True,
+  'type': 'tag[]',
+  'empty': False
+}])
+
+@app.route('/tag-batch', methods=['POST'])
+async def tag_batch(request):
+  try:
+    request_body = parse_body(request)
+  except TMVException as e:
+    return error(request, e.error_id, e.error_msg)
+
+  try:
+    verify_tag_batch_input(request_body)
+
+    entries = [{
+      'value': v['value'],
+      'multi_tags': v['multi_tags'] if 'multi_tags' in v else [],
+      'value_tags': v['value_tags'] if 'value_tags' in v else []
+    } for v in request_body['values']]
+
+    await run_db(database.tag_batch, entries)
+    return respond(request, {'success': True})
   except TMVException as e:
-    return error(e.error_id, e.error_msg)
+    return error(request, e.error_id, e.error_msg)
   except Exception as e:
-    return unknown_error(e)
+    return unknown_error(request, e)
 
 # Expected request format:
 #
@@ -304,47 +471,49 @@ async def tag(request):
 #   ?'error_id': INTEGER,
 #   ?'error_msg': STRING,
 # }
+verify_untag_input = compile_input([{
+  'name': 'value',
+  'required': True,
+  'type': 'str',
+}, {
+  'name': 'multi_tags',
+  'required': False,
+  'type': 'str[]',
+  'empty': False
+}, {
+  'name': 'value_tags',
+  'required': False,
+  'type': 'val[]',
+  'empty': False
+}, {
+  'name': 'all',
+  'required': False,
+  'type': 'bool'
+}])
+
 @app.route('/untag', methods=['POST'])
 async def untag(request):
   try:
-    request_body = request.json
-  except Exception as e:
-    return error(TMVException.ID_PARSE_JSON, 'Couldn\'t parse request body as JSON')
+    request_body = parse_body(request)
+  except TMVException as e:
+    return error(request, e.error_id, e.error_msg)
 
   try:
-    verify_input(request_body, [{
-      'name': 'value',
-      'required': True,
-      'type': 'str',
-    }, {
-      'name': 'multi_tags',
-      'required': False,
-      'type': 'str[]',
-      'empty': False
-    }, {
-      'name': 'value_tags',
-      'required': False,
-      'type': 'val[]',
-      'empty': False
-    }, {
-      'name': 'all',
-      'required': False,
-      'type': 'bool'
-    }])
+    verify_untag_input(request_body)
 
     value_tags = request_body['value_tags'] if 'value_tags' in request_body else []
     multi_tags = request_body['multi_tags'] if 'multi_tags' in request_body else []
     all        = request_body['all'       ] if 'all'        in request_body else False
 
     if all:
-      database.untag_all(request_body['value'])
+      await run_db(database.untag_all, request_body['value'])
     else:
-      database.untag(request_body['value'], value_tags, multi_tags)
-    return json({'success': True})
+      await run_db(database.untag, request_body['value'], value_tags, multi_tags)
+    return respond(request, {'success': True})
   except TMVException as e:
-    return error(e.error_id, e.error_msg)
+    return error(request, e.error_id, e.error_msg)
   except Exception as e:
-    return unknown_error(e)
+    return unknown_error(request, e)
 
 # Expected request format:
 #
@@ -360,35 +529,37 @@ async def untag(request):
 #   ?'error_id': INTEGER,
 #   ?'error_msg': STRING,
 # }
+verify_delete_tags_input = compile_input([{
+  'name': 'multi_tags',
+  'required': False,
+  'type': 'str[]',
+  'empty': False,
+}, {
+  'name': 'value_tags',
+  'required': False,
+  'type': 'val[]',
+  'empty': False,
+}])
+
 @app.route('/delete-tags', methods=['POST'])
 async def delete_tags(request):
   try:
-    request_body = request.json
-  except Exception as e:
-    return error(TMVException.ID_PARSE_JSON, 'Couldn\'t parse request body as JSON')
+    request_body = parse_body(request)
+  except TMVException as e:
+    return error(request, e.error_id, e.error_msg)
 
   try:
-    verify_input(request_body, [{
-      'name': 'multi_tags',
-      'required': False,
-      'type': 'str[]',
-      'empty': False,
-    }, {
-      'name': 'value_tags',
-      'required': False,
-      'type': 'val[]',
-      'empty': False,
-    }])
+    verify_delete_tags_input(request_body)
 
     multi = request_body['multi_tags'] if 'multi_tags' in request_body else []
     value = request_body['value_tags'] if 'value_tags' in request_body else []
 
-    database.delete_tags(multi, value)
-    return json({'success': True})
+    await run_db(database.delete_tags, multi, value)
+    return respond(request, {'success': True})
   except TMVException as e:
-    return error(e.error_id, e.error_msg)
+    return error(request, e.error_id, e.error_msg)
   except Exception as e:
-    return unknown_error(e)
+    return unknown_error(request, e)
 
 # Expected request format:
 #
@@ -396,6 +567,7 @@ async def delete_tags(request):
 #   ?'values': [{'old': STRING, 'new': STRING}, ...]
 #   ?'value_tags': [{'old': {'name': STRING, 'value': INTEGER}, 'new': {'name': STRING, 'value': INTEGER}}, ...]
 #   ?'multi_tags': [{'old': STRING, 'new': STRING}, ...]
+#   ?'merge': BOOLEAN # Merge tags into existing ones with the new name instead of failing. Defaults to false
 # }
 #
 # Expected response:
@@ -405,44 +577,51 @@ async def delete_tags(request):
 #   ?'error_id': INTEGER,
 #   ?'error_msg': STRING,
 # }
+verify_rename_input = compile_input([{
+  'name': 'values',
+  'required': False,
+  'type': 'oldnew[]',
+  'empty': False
+}, {
+  'name': 'multi_tags',
+  'required': False,
+  'type': 'oldnew[]',
+  'empty': False
+}, {
+  'name': 'value_tags',
+  'required': False,
+  'type': 'oldnew-val[]',
+  'empty': False
+}, {
+  'name': 'merge',
+  'required': False,
+  'type': 'bool'
+}])
+
 @app.route('/rename', methods=['POST'])
 async def rename(request):
   try:
-    request_body = request.json
-  except Exception as e:
-    return error(TMVException.ID_PARSE_JSON, 'Couldn\'t parse request body as JSON')
+    request_body = parse_body(request)
+  except TMVException as e:
+    return error(request, e.error_id, e.error_msg)
 
   try:
-    verify_input(request_body, [{
-      'name': 'values',
-      'required': False,
-      'type': 'oldnew[]',
-      'empty': False
-    }, {
-      'name': 'multi_tags',
-      'required': False,
-      'type': 'oldnew[]',
-      'empty': False
-    }, {
-      'name': 'value_tags',
-      'required': False,
-      'type': 'oldnew-val[]',
-      'empty': False
-    }])
+    verify_rename_input(request_body)
 
     values    = request_body['values'    ] if 'values'     in request_body else []
     multitags = request_body['multi_tags'] if 'multi_tags' in request_body else []
     valuetags = request_body['value_tags'] if 'value_tags' in request_body else []
+    merge     = request_body['merge'     ] if 'merge'      in request_body else False
 
     if len(values) < 1 and len(multitags) < 1 and len(valuetags) < 1:
       raise TMVException(TMVException.ID_FAULTY_INPUT, 'At least one of the input fields \'values\', \'multi_tags\', \'value_tags\' has to not be empty')
 
-    database.rename(values, multitags, valuetags)
-    return json({'success': True})
+    await run_db(database.rename, values, multitags, valuetags, merge)
+    return respond(request, {'success': True})
   except TMVException as e:
-    return error(e.error_id, e.error_msg)
+    return error(request, e.error_id, e.error_msg)
   except Exception as e:
-    return unknown_error(e)
+    return unknown_error(request, e)
 
 # Expected request format
 #
@@ -459,27 +638,29 @@ async def rename(request):
 #   ?'error_id': INTEGER,
 #   ?'error_msg': STRING,
 # }
+verify_tag_tags_input = compile_input([{
+  'name': 'multi_tags',
+  'required': True,
+  'type': 'str:str[]',
+  'empty': False
+}])
+
 @app.route('/tag-tags', methods=['POST'])
 async def tag_tags(request):
   try:
-    request_body = request.json
-  except Exception as e:
-    return error(TMVException.ID_PARSE_JSON, 'Couldn\'t parse request body as JSON')
+    request_body = parse_body(request)
+  except TMVException as e:
+    return error(request, e.error_id, e.error_msg)
 
   try:
-    verify_input(request_body, [{
-      'name': 'multi_tags',
-      'required': True,
-      'type': 'str:str[]',
-      'empty': False
-    }])
-
-    database.tag_tags(request_body['multi_tags'])
-    return json({'success': True})
+    verify_tag_tags_input(request_body)
+
+    await run_db(database.tag_tags, request_body['multi_tags'])
+    return respond(request, {'success': True})
   except TMVException as e:
-    return error(e.error_id, e.error_msg)
+    return error(request, e.error_id, e.error_msg)
   except Exception as e:
-    return unknown_error(e)
+    return unknown_error(request, e)
 
 # Expected request format
 #
@@ -498,26 +679,28 @@ async def tag_tags(request):
 #   ?'error_id': INTEGER,
 #   ?'error_msg': STRING,
 # }
+verify_get_related_tags_input = compile_input([{
+  'name': 'multi_tags',
+  'required': True,
+  'type': 'str[]',
+  'empty': False
+}])
+
 @app.route('/get-related-tags', methods=['POST'])
 async def get_related_tags(request):
   try:
-    request_body = request.json
-  except Exception as e:
-    return error(TMVException.ID_PARSE_JSON, 'Couldn\'t parse request body as JSON')
+    request_body = parse_body(request)
+  except TMVException as e:
+    return error(request, e.error_id, e.error_msg)
   try:
-    verify_input(request_body, [{
-      'name': 'multi_tags',
-      'required': True,
-      'type': 'str[]',
-      'empty': False
-    }])
-
-    retval = database.get_implied_tags(request_body['multi_tags'])
-    return json({'response': retval})
+    verify_get_related_tags_input(request_body)
+
+    retval = await run_db(database.get_implied_tags, request_body['multi_tags'])
+    return respond(request, {'response': retval})
   except TMVException as e:
-    return error(e.error_id, e.error_msg)
+    return error(request, e.error_id, e.error_msg)
   except Exception as e:
-    return unknown_error(e)
+    return unknown_error(request, e)
 
 # Expected request format
 #
@@ -535,38 +718,142 @@ async def get_related_tags(request):
 #   ?'error_id': INTEGER,
 #   ?'error_msg': STRING,
 # }
+verify_untag_tags_input = compile_input([{
+  'name': 'multi_tags',
+  'required': True,
+  'type': 'str:str[]|all',
+  'empty': False
+}])
+
 @app.route('/untag-tags', methods=['POST'])
 async def untag_tags(request):
   try:
-    request_body = request.json
+    request_body = parse_body(request)
+  except TMVException as e:
+    return error(request, e.error_id, e.error_msg)
+
+  try:
+    verify_untag_tags_input(request_body)
+
+    await run_db(database.untag_tags, request_body['multi_tags'])
+    return respond(request, {'success': True})
+  except TMVException as e:
+    return error(request, e.error_id, e.error_msg)
   except Exception as e:
-    return error(TMVException.ID_PARSE_JSON, 'Couldn\'t parse request body as JSON')
+    return unknown_error(request, e)
 
+# Expected request format
+#
+# {}
+#
+# Expected response:
+#
+# {
+#   ?'response': {
+#     'tag_id_cache': {'hits': INTEGER, 'misses': INTEGER, 'size': INTEGER, 'max_size': INTEGER, 'bytes': INTEGER, 'max_bytes': ?INTEGER},
+#     'search_cache': {'hits': INTEGER, 'misses': INTEGER, 'size': INTEGER, 'max_size': INTEGER, 'bytes': INTEGER, 'max_bytes': ?INTEGER},
+#     'search_engine': ?{'tagged': INTEGER, 'multi_tags': INTEGER, 'value_tags': INTEGER},
+#     'orphan_sweeper': ?{
+#       'runs': INTEGER,
+#       'deleted': {'tagged': INTEGER, 'multi_tags': INTEGER, 'value_tags': INTEGER},
+#       'backlog': {'tagged': ?INTEGER, 'multi_tags': ?INTEGER, 'value_tags': ?INTEGER}, # As of the last run
+#       'last_run_seconds': ?FLOAT,
+#       'last_run_at': ?FLOAT # Unix time
+#     }
+#   }
+#   ?'error_id': INTEGER,
+#   ?'error_msg': STRING,
+# }
+@app.route('/get-stats', methods=['POST'])
+async def get_stats(request):
   try:
-    verify_input(request_body, [{
-      'name': 'multi_tags',
-      'required': True,
-      'type': 'str:str[]',
-      'empty': False
-    }])
-
-    database.untag_tags(request_body['multi_tags'])
-    return json({'success': True})
+    return respond(request, {'response': database.get_stats()})
   except TMVException as e:
-    return error(e.error_id, e.error_msg)
+    return error(request, e.error_id, e.error_msg)
   except Exception as e:
-    return unknown_error(e)
+    return unknown_error(request, e)
+
+# Prometheus metrics of this tagger process, in the text exposition format
+@app.route('/metrics', methods=['GET'])
+async def get_metrics(request):
+  return text(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# Unmatched paths are grouped together, so that probing random URLs can't create new series
+def _route_label(request):
+  return request.path if getattr(request, 'route', None) is not None else 'unmatched'
+
+@app.middleware('request')
+async def start_request_timer(request):
+  request.ctx.start = time.perf_counter()
+
+# Streamed responses are recorded when they're started, not when they're done
+@app.middleware('response')
+async def record_request_metrics(request, response):
+  route = _route_label(request)
+  metrics.REQUESTS.inc((route, request.method, response.status))
+  start = getattr(request.ctx, 'start', None)
+  if start is not None:
+    metrics.REQUEST_SECONDS.observe((route, request.method), time.perf_counter() - start)
 
 # Exception handlers
 @app.exception(NotFound)
 async def not_found_exception(request, exception):
-  return error(TMVException.ID_404, 'Endpoint not found')
+  return error(request, TMVException.ID_404, 'Endpoint not found')
 
 @app.exception(MethodNotSupported)
 async def not_found_exception(request, exception):
-  return error(TMVException.ID_405, 'Method \'{}\' is not supported. The TMV tagger only supports POST requests.'.format(request.method))
+  return error(request, TMVException.ID_405, 'Method \'{}\' is not supported. The TMV tagger only supports POST requests.'.format(request.method))
+
+@app.listener('before_server_start')
+async def start_database_executor(app, loop):
+  global _DB_EXECUTOR
+  _DB_EXECUTOR = ThreadPoolExecutor(max_workers=int(dotenv.read()['TMV_TAGGER_DB_THREADS']), thread_name_prefix='tmv-db')
+
+@app.listener('before_server_start')
+async def limit_streams(app, loop):
+  global _STREAMS
+  env = dotenv.read()
+  # At least one connection is always left for requests that aren't streamed
+  _STREAMS = asyncio.Semaphore(max(1, min(int(env['TMV_TAGGER_MAX_STREAMS']), int(env['TMV_DB_POOL_MAX_SIZE']) - 1)))
+
+@app.listener('before_server_start')
+async def load_search_engine(app, loop):
+  await run_db(database.load_search_engine)
+
+  interval = float(dotenv.read()['TMV_TAGGER_SEARCH_ENGINE_RELOAD_INTERVAL'])
+  if interval > 0:
+    app.add_task(reload_search_engine(interval))
+
+async def reload_search_engine(interval):
+  while True:
+    await asyncio.sleep(interval)
+    try:
+      await run_db(database.load_search_engine)
+    except Exception as e:
+      print_exception(e)
+
+@app.listener('before_server_start')
+async def start_orphan_sweeper(app, loop):
+  interval = float(dotenv.read()['TMV_TAGGER_ORPHAN_SWEEP_INTERVAL'])
+  if interval > 0:
+    app.add_task(sweep_orphans(interval, int(dotenv.read()['TMV_TAGGER_ORPHAN_SWEEP_BATCH_SIZE'])))
+
+async def sweep_orphans(interval, batch_size):
+  while True:
+    await asyncio.sleep(interval)
+    try:
+      await run_db(database.sweep_orphans, batch_size)
+    except Exception as e:
+      print_exception(e)
+
+@app.listener('after_server_stop')
+async def close_database_pool(app, loop):
+  _DB_EXECUTOR.shutdown(wait=True)
+  database.close_pool()
 
 if __name__ == '__main__':
   database.create_tables()
+  migrations.migrate()
+  database.close_pool() # Don't share the startup connections with forked workers
   app.run(host='0.0.0.0', port=8000)
 
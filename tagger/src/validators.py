@@ -0,0 +1,251 @@
+from TMVException import TMVException
+
+# Request body validation.
+#
+# compile_input() turns a schema into a function checking request bodies against it. Schemas are compiled once,
+# when the routes are defined, so a request only pays for the checks themselves: every parameter has its checking
+# function and error messages prepared up front, and arrays are walked exactly once.
+#
+# Schema format:
+#
+# [{
+#   'name': STRING,
+#   'required': BOOLEAN,
+#   'type': STRING, # One of the keys of _TYPES
+#    ?'empty': BOOLEAN, # Whether arrays and dicts may be empty. Defaults to False
+#    ?'min': INTEGER, # Smallest allowed 'int'
+#    ?'max': INTEGER # Largest allowed 'int'
+# }, ...]
+
+def _fail(msg):
+  raise TMVException(TMVException.ID_FAULTY_INPUT, msg)
+
+def _msg(e, fmt):
+  return fmt.format(e['name'])
+
+def _is_valuetag(v):
+  return isinstance(v, dict) and isinstance(v.get('name'), str) and isinstance(v.get('value'), int)
+
+def _check_empty(e):
+  if e.get('empty', False):
+    return lambda param: None
+
+  msg = _msg(e, 'Parameter \'{}\' cannot be empty')
+  def check(param):
+    if len(param) < 1:
+      _fail(msg)
+  return check
+
+def _str(e):
+  msg = _msg(e, 'Parameter \'{}\' not a string as expected')
+  def check(param):
+    if not isinstance(param, str):
+      _fail(msg)
+  return check
+
+def _bool(e):
+  msg = _msg(e, 'Parameter \'{}\' not a boolean as expected')
+  def check(param):
+    if not isinstance(param, bool):
+      _fail(msg)
+  return check
+
+def _int(e):
+  msg = _msg(e, 'Parameter \'{}\' not an integer as expected')
+  minimum = e.get('min')
+  maximum = e.get('max')
+  min_msg = 'Parameter \'{}\' cannot be less than {}'.format(e['name'], minimum)
+  max_msg = 'Parameter \'{}\' cannot be more than {}'.format(e['name'], maximum)
+  def check(param):
+    if not isinstance(param, int) or isinstance(param, bool):
+      _fail(msg)
+    if minimum is not None and param < minimum:
+      _fail(min_msg)
+    if maximum is not None and param > maximum:
+      _fail(max_msg)
+  return check
+
+def _str_array(e):
+  msg = _msg(e, 'Parameter \'{}\' not a string array as expected')
+  check_empty = _check_empty(e)
+  def check(param):
+    if not isinstance(param, list):
+      _fail(msg)
+    check_empty(param)
+    for v in param:
+      if not isinstance(v, str):
+        _fail(msg)
+  return check
+
+def _str_or_str_array(e):
+  msg = _msg(e, 'Parameter \'{}\' not a string or string array as expected')
+  check_empty = _check_empty(e)
+  def check(param):
+    if isinstance(param, str):
+      return
+    if not isinstance(param, list):
+      _fail(msg)
+    check_empty(param)
+    for v in param:
+      if not isinstance(v, str):
+        _fail(msg)
+  return check
+
+def _str_to_str_array(e, allow_all=False):
+  msg = _msg(e, 'Parameter \'{}\' not a STRING: STRING[] dict as expectd' if not allow_all else 'Parameter \'{}\' not a STRING: STRING[] or \'all\' dict as expected')
+  empty_value_msg = _msg(e, 'Parameter \'{}\' cannot have empty value lists')
+  allow_empty = e.get('empty', False)
+  check_empty = _check_empty(e)
+  def check(param):
+    if not isinstance(param, dict):
+      _fail(msg)
+    check_empty(param)
+    for k, v in param.items():
+      if not isinstance(k, str):
+        _fail(msg)
+      if allow_all and v == 'all':
+        continue
+      if not isinstance(v, list):
+        _fail(msg)
+      if len(v) < 1 and not allow_empty:
+        _fail(empty_value_msg)
+      for s in v:
+        if not isinstance(s, str):
+          _fail(msg)
+  return check
+
+# Same as 'str:str[]', but a value can also be the string 'all'
+def _str_to_str_array_or_all(e):
+  return _str_to_str_array(e, allow_all=True)
+
+def _val_array(e):
+  msg = _msg(e, 'Parameter \'{}\' not an array as expected')
+  object_msg = _msg(e, 'Parameter \'{}\' not an array of objects as expected')
+  format_msg = _msg(e, 'Parameter \'{}\' not an array of objects formatted as expected')
+  check_empty = _check_empty(e)
+  def check(param):
+    if not isinstance(param, list):
+      _fail(msg)
+    check_empty(param)
+    for v in param:
+      if not isinstance(v, dict):
+        _fail(object_msg)
+      if not _is_valuetag(v):
+        _fail(format_msg)
+  return check
+
+_TAG_KEYS = frozenset(['value', 'multi_tags', 'value_tags'])
+
+def _tag_array(e):
+  msg = _msg(e, 'Parameter \'{}\' not an array as expected')
+  format_msg = _msg(e, 'Parameter \'{}\' not an array of objects formatted as expected')
+  check_empty = _check_empty(e)
+  def check(param):
+    if not isinstance(param, list):
+      _fail(msg)
+    check_empty(param)
+    for v in param:
+      if not isinstance(v, dict) or not isinstance(v.get('value'), str) or not _TAG_KEYS.issuperset(v):
+        _fail(format_msg)
+      if 'multi_tags' in v:
+        multi_tags = v['multi_tags']
+        if not isinstance(multi_tags, list):
+          _fail(format_msg)
+        for t in multi_tags:
+          if not isinstance(t, str):
+            _fail(format_msg)
+      if 'value_tags' in v:
+        value_tags = v['value_tags']
+        if not isinstance(value_tags, list):
+          _fail(format_msg)
+        for t in value_tags:
+          if not _is_valuetag(t):
+            _fail(format_msg)
+  return check
+
+_QUERY_TAG_TYPES = frozenset(['value', 'multi'])
+
+def _qtag_array(e):
+  msg = _msg(e, 'Parameter \'{}\' not an array as expected')
+  value_msg = _msg(e, 'Parameter \'{}\' can only contain \'value\', or \'multi\'')
+  check_empty = _check_empty(e)
+  def check(param):
+    if not isinstance(param, list):
+      _fail(msg)
+    check_empty(param)
+    for v in param:
+      if not isinstance(v, str) or v not in _QUERY_TAG_TYPES:
+        _fail(value_msg)
+  return check
+
+_OLDNEW_KEYS = frozenset(['old', 'new'])
+
+# [{'old': STRING, 'new': STRING}, ...]
+def _oldnew_array(e):
+  msg = _msg(e, 'Parameter \'{}\' not an array as expected')
+  format_msg = _msg(e, 'Parameter \'{}\' not an array of {{\'old\': STRING, \'new\': STRING}} objects as expected')
+  check_empty = _check_empty(e)
+  def check(param):
+    if not isinstance(param, list):
+      _fail(msg)
+    check_empty(param)
+    for v in param:
+      if not isinstance(v, dict) or v.keys() != _OLDNEW_KEYS or not isinstance(v['old'], str) or not isinstance(v['new'], str):
+        _fail(format_msg)
+  return check
+
+# [{'old': {'name': STRING, 'value': INTEGER}, 'new': {'name': STRING, 'value': INTEGER}}, ...]
+def _oldnew_val_array(e):
+  msg = _msg(e, 'Parameter \'{}\' not an array as expected')
+  format_msg = _msg(e, 'Parameter \'{}\' not an array of {{\'old\': VALUETAG, \'new\': VALUETAG}} objects as expected')
+  check_empty = _check_empty(e)
+  def check(param):
+    if not isinstance(param, list):
+      _fail(msg)
+    check_empty(param)
+    for v in param:
+      if not isinstance(v, dict) or v.keys() != _OLDNEW_KEYS or not _is_valuetag(v['old']) or not _is_valuetag(v['new']):
+        _fail(format_msg)
+  return check
+
+_TYPES = {
+  'str': _str,
+  'bool': _bool,
+  'int': _int,
+  'str[]': _str_array,
+  'str,str[]': _str_or_str_array,
+  'str:str[]': _str_to_str_array,
+  'str:str[]|all': _str_to_str_array_or_all,
+  'val[]': _val_array,
+  'tag[]': _tag_array,
+  'qtag[]': _qtag_array,
+  'oldnew[]': _oldnew_array,
+  'oldnew-val[]': _oldnew_val_array
+}
+
+# Returns FUNCTION(request_body), raising a TMVException if the body doesn't match the schema
+def compile_input(expected):
+  checks = {}
+  required = []
+  for e in expected:
+    if e['type'] not in _TYPES:
+      raise ValueError('Unknown input type \'{}\' for parameter \'{}\''.format(e['type'], e['name']))
+    checks[e['name']] = _TYPES[e['type']](e)
+    if e['required']:
+      required.append((e['name'], 'Required parameter \'{}\' not found in request body'.format(e['name'])))
+
+  def verify(request):
+    if not isinstance(request, dict):
+      _fail('Request body not a JSON object as expected')
+
+    for name in request:
+      if name not in checks:
+        _fail('Given parameter \'{}\' not expected'.format(name))
+
+    for name, msg in required:
+      if name not in request:
+        _fail(msg)
+
+    for name, param in request.items():
+      checks[name](param)
+  return verify